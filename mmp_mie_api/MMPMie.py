@@ -14,22 +14,29 @@
 # limitations under the License.
 #
 
+import hashlib
+import json
 import socket
 import sys
 import threading
 import os
 
 import Pyro4
-import h5py
 from mupif import APIError
-from mupif import Field
-from mupif import PropertyID, FieldID
+from mupif import PropertyID
 from mupif import ValueType
 from mupif.Application import Application
 from mupif.Property import Property
 from .mie import mieDatabase
+from .mie import mieStorage
+from .mie import phaseFit
+from .mie import refractiveIndex
+from .mie.mieSampler import InverseCDFSampler, AliasSampler, uniformRVs
+from .mie.telemetry import telemetry
+from .propertyStore import PropertyStore
+from .arrayTransport import TransferRegistry
+from .solveQueue import SolveQueue, SUPERSEDED
 
-import pandas as pd
 import numpy as np
 import initialConfiguration as initConf
 import objID
@@ -53,6 +60,34 @@ sys.excepthook = Pyro4.util.excepthook
 Pyro4.config.SERIALIZERS_ACCEPTED = ['pickle', 'serpent', 'json']
 Pyro4.config.SERIALIZER = 'pickle'
 
+# Property IDs until implemented at mupif ###
+for (_name, _value) in [('PID_PhaseFitParameters', 27),
+                        ('PID_PhaseFitError', 28),
+                        ('PID_AsymmetryFactor', 29),
+                        ('PID_LEDSpectrum', 24),
+                        ('PID_SpectralBands', 30)]:
+    if not hasattr(PropertyID, _name):
+        setattr(PropertyID, _name, _value)
+###############################################
+
+
+def _jsonDefault(value):
+    if isinstance(value, complex):
+        return([value.real, value.imag])
+    if isinstance(value, np.ndarray):
+        return(value.tolist())
+    if isinstance(value, np.generic):
+        return(value.item())
+    return(repr(value))
+
+
+def _fingerprint(params):
+    """
+    Hash of a parameter dict, used to detect unchanged inputs.
+    """
+    text = json.dumps(params, sort_keys=True, default=_jsonDefault)
+    return(hashlib.sha1(text.encode('utf-8')).hexdigest())
+
 
 class MMPMie(Application):
 
@@ -75,29 +110,63 @@ class MMPMie(Application):
         # Containers
         # Properties
         # Key should be in form of tuple (propertyID, objectID, tstep)
-        idx = pd.MultiIndex.from_tuples(
-            [(PropertyID.PID_RefractiveIndex, 1.0, 1.0)],
-            names=['propertyID', 'objectID', 'tstep'])
-        self.properties = pd.Series(index=idx, dtype=Property)
+        self.properties = PropertyStore(('propertyID', 'objectID', 'tstep'))
 
         # Fields
         # Key should be in form of tuple (fieldID, tstep)
-        idxf = pd.MultiIndex.from_tuples(
-            [(FieldID.FID_Thermal_absorption_volume, 1.0)],
-            names=['fieldID', 'tstep'])
-        self.fields = pd.Series(index=idxf, dtype=Field.Field)
+        self.fields = PropertyStore(('fieldID', 'tstep'))
 
-        self.mieThread = None
+        # Solve requests are run one at a time in a worker thread
+        self.solveQueue = SolveQueue(self._timedMieProcess)
+        self.batchQueue = SolveQueue(self._solveBatch, coalesce=False)
+        # Open bulk transfers of array properties
+        self.transfers = TransferRegistry()
         self.wavelengths = None
         self.crossSections = None
         self.invCDF = None
+        # Mie table file of each particle object ID from the latest solve
+        self.mieFiles = {}
+        # Scattering angle sampler of each particle object ID
+        self.samplers = {}
+        # Table status of each particle object ID (approximate, distance)
+        self.tableInfo = {}
+        # Job parameters of the published table of each particle object ID
+        self._publishedJobs = {}
+        # Max parameter distance of approximate tables, None = disabled
+        self.approximateDistance = None
+        # Coarse table settings of progressive mode, None = disabled
+        self.progressive = None
+        self._exactThreads = {}
+        # Precision of the inverse CDF tables, see setPrecision
+        self.precision = 'float64'
+        # Sampling representation of new tables, see setSampling
+        self.sampling = 'inverseCDF'
+        # Max error of adaptive RV grids, see setRVTolerance
+        self.rvTolerance = None
+        # Parametric phase function model of new tables, see setPhaseFit
+        self.phaseFit = None
+        # Accuracy of the Rayleigh and large particle approximations,
+        # None = full Mie solution, see setRegimeTolerance
+        self.regimeTolerance = None
+        # Rounding step of dispersive refractive indices, see setIndexStep
+        self.indexStep = None
+        # Max spectral bands of the LED spectrum, None = full tables,
+        # see setSpectralBands
+        self.spectralBins = None
+        # Fingerprints of the published and the latest queued bands
+        self._bandFingerprint = None
+        self._bandRequested = None
+        # Grid sizes of the Mie tables, see setResolution
+        self.resolution = mieDatabase.resolutionProfile('standard')
+        # Fingerprint of the inputs of each published particle type
+        self._fingerprints = {}
+        # Fingerprint of the latest queued inputs of each particle type
+        self._requested = {}
+        # Fingerprint of the parameters of each running exact generation
+        self._exactParams = {}
+        self._tableLock = threading.RLock()
 
         #############################
-        # Empty old properties
-        self.properties.drop(self.properties.index, inplace=True)
-        # Empty old fields
-        self.fields.drop(self.fields.index, inplace=True)
-
         # Initial values
 
         # User must set these 2 properties for other particle
@@ -160,33 +229,33 @@ class MMPMie(Application):
         numw = Property(value=w_num, propID=PropertyID.PID_Wavelen_n, valueType=ValueType.Scalar, time=0.0, units=None, objectID=objID.OBJ_PARTICLE_TYPE_1)
         """
         key = (mup.getPropertyID(), mup.getObjectID(), 0)
-        self.properties.loc[key] = mup
+        self.properties[key] = mup
         key = (sigmap.getPropertyID(), sigmap.getObjectID(), 0)
-        self.properties.loc[key] = sigmap
+        self.properties[key] = sigmap
         """
         key = (maxp.getPropertyID(), maxp.getObjectID(), 0)
-        self.properties.loc[key] = maxp
+        self.properties[key] = maxp
         key = (minp.getPropertyID(), minp.getObjectID(), 0)
-        self.properties.loc[key] = minp
+        self.properties[key] = minp
         key = (nump.getPropertyID(), nump.getObjectID(), 0)
-        self.properties.loc[key] = nump
+        self.properties[key] = nump
         key = (maxw.getPropertyID(), maxw.getObjectID(), 0)
-        self.properties.loc[key] = maxw
+        self.properties[key] = maxw
         key = (minw.getPropertyID(), minw.getObjectID(), 0)
-        self.properties.loc[key] = minw
+        self.properties[key] = minw
         key = (numw.getPropertyID(), numw.getObjectID(), 0)
-        self.properties.loc[key] = numw
+        self.properties[key] = numw
         """
         #End of new properties from MiM..............
 
         key = (nr.getPropertyID(), nr.getObjectID(), 0)
-        self.properties.loc[key] = nr
+        self.properties[key] = nr
         key = (nrh.getPropertyID(), nrh.getObjectID(), 0)
-        self.properties.loc[key] = nrh
+        self.properties[key] = nrh
         key = (scatCross.getPropertyID(), scatCross.getObjectID(), 0)
-        self.properties.loc[key] = scatCross
+        self.properties[key] = scatCross
         key = (invPhase.getPropertyID(), invPhase.getObjectID(), 0)
-        self.properties.loc[key] = invPhase
+        self.properties[key] = invPhase
         #############################
 
     def getField(self, fieldID, time):
@@ -208,9 +277,9 @@ class MMPMie(Application):
 
         :param Field field: Remote field to be registered by the application
         """
-        # Set the new property to container
-        key = (field.getPropertyID(), field.getTime())
-        self.fields.set_value(key, field)
+        # Set the new field to container
+        key = (field.getFieldID(), field.getTime())
+        self.fields[key] = field
 
     def getProperty(self, propID, time, objectID=0):
         """
@@ -225,10 +294,10 @@ class MMPMie(Application):
         :rtype: Property
         """
         key = (propID, objectID, time)
-        if propID not in self.properties.index:
+        if not self.properties.contains('propertyID', propID):
             raise APIError.APIError('Unknown property ID')
 
-        if key not in self.properties.index:
+        if key not in self.properties:
             raise Exception('Not implemented')
         else:
             prop = self.properties[key]
@@ -253,6 +322,17 @@ class MMPMie(Application):
         key = (newProp.getPropertyID(), newProp.getObjectID(), newProp.time)
         self.properties[key] = newProp
 
+    def pruneTimeSteps(self, before):
+        """
+        Removes properties and fields of time steps earlier than before.
+        The initial values (time step 0) are kept.
+
+        :param float before: First time step to keep
+        :return: Number of removed properties and fields
+        :rtype: int
+        """
+        return(self.properties.prune(before) + self.fields.prune(before))
+
     def getMesh(self, tstep):
         """
         Returns the computational mesh for given solution step.
@@ -287,32 +367,144 @@ class MMPMie(Application):
         the solution will run in background (in separate thread or remotely).
 
         """
-        if self.mieThread:
-            if self.mieThread.is_alive():
-                return
+        requestID = self.submitSolve(tstep)
+        if (not runInBackground and requestID is None and
+                not self.solveQueue.idle()):
+            # Unchanged inputs may be in flight from a background solve,
+            # publish them before returning. Types whose background
+            # solve failed are solved again.
+            self.wait()
+            requestID = self.submitSolve(tstep)
 
+        # Wait for process if applicaple
+        if not runInBackground and requestID is not None:
+            future = self.solveQueue.future(requestID)
+            future.result()
+            if future.state == SUPERSEDED:
+                self.wait()
+        return(requestID)
+
+    def submitSolve(self, tstep):
+        """
+        Queues a solve of the current parameters without waiting. Queued
+        requests whose particle types are taken over by a newer request
+        are coalesced and never solved.
+
+        :param TimeStep tstep: Solution step
+        :return: Request ID, or None if no inputs changed
+        :rtype: int
+        """
         # Check params and fields
         initConf.checkRequiredParameters(self.properties, PropertyID)
 
-        # tstep is needed in _startmieProcess to get the Properties
-        params = {'tstep': tstep}
+        with self._tableLock:
+            # Only particle types whose inputs changed are solved again
+            jobs = self._changedJobs(self._collectJobs(tstep))
+            # Solved types are band averaged again by the queued request
+            # if the spectrum changed
+            bands = self._bandKey()
+            if not jobs and bands == self._bandRequested:
+                logger.debug('Inputs unchanged, skipping solve')
+                telemetry.count('unchangedSolves')
+                return(None)
+
+            for (objectID, params) in jobs.items():
+                self._requested[objectID] = _fingerprint(params)
+            self._bandRequested = bands
+            future = self.solveQueue.submit(jobs, tstep=tstep, bands=bands)
+        telemetry.count('solveRequests')
+        return(future.requestID)
+
+    def solveBatch(self, param_sets, include_data=True):
+        """
+        Solves many parameter sets in one call. Misses are generated
+        together, grouped by optical constants and grids so that Mie
+        kernels are shared between the sets. The published scattering
+        properties are not changed.
+
+        :param list param_sets: Dicts of n_particle, n_host and either
+               particle_mu and particle_sigma or particle_distribution
+               (with id_1 and id_2). Grid sizes (wavelen_n, wavelen_max,
+               wavelen_min, particle_n, particle_max, particle_min,
+               theta_n, rv_n) default to those of solveStep.
+        :param bool include_data: Include the tables, otherwise only
+               the filenames are returned
+        :return: Per set a dict of filename and, with include_data,
+                 wavelengths, crossSections, inverseCDF (Row = RV,
+                 Column = wavelength), rvs and with setPhaseFit phaseFit
+                 (model, parameters, error and asymmetry)
+        :rtype: list
+        """
+        jobs = dict(enumerate(self._batchParams(param_sets)))
+        return(self._solveBatch(jobs, include_data=include_data))
 
-        # Start thread to start Mie calculation
-        self.mieThread = threading.Thread(target=self._startMieProcess,
-                                          kwargs=params,
-                                          group=None)
-        self.mieThread.start()
+    def submitBatch(self, param_sets, include_data=True):
+        """
+        Queues a batch as in solveBatch without waiting. The results are
+        returned by getBatchResult.
 
-        # Wait for process if applicaple
-        if not runInBackground:
-            self.mieThread.join()
+        :return: Request ID
+        :rtype: int
+        """
+        jobs = dict(enumerate(self._batchParams(param_sets)))
+        future = self.batchQueue.submit(jobs, include_data=include_data)
+        return(future.requestID)
+
+    def getBatchResult(self, requestID, timeout=0.0):
+        """
+        Waits at most timeout seconds for a queued batch.
+
+        :param int requestID: Request ID from submitBatch
+        :param float timeout: Seconds, None waits until finished
+        :return: Status as in getSolveStatus, with the results of
+                 solveBatch in results when done
+        :rtype: dict
+        """
+        try:
+            future = self.batchQueue.future(requestID)
+        except KeyError as e:
+            raise APIError.APIError(str(e))
+        future.wait(timeout)
+        status = future.status()
+        status['results'] = future.value
+        return(status)
+
+    def getSolveStatus(self, requestID):
+        """
+        Non-blocking status of a solve request.
+
+        :param int requestID: Request ID from solveStep or submitSolve
+        :return: requestID, state (queued, running, done, failed or
+                 superseded), objectIDs, pending objectIDs, supersededBy
+                 (objectID: requestID) and error
+        :rtype: dict
+        """
+        try:
+            return(self.solveQueue.future(requestID).status())
+        except KeyError as e:
+            raise APIError.APIError(str(e))
+
+    def waitSolve(self, requestID, timeout=None):
+        """
+        Waits at most timeout seconds for a solve request.
+
+        :param int requestID: Request ID from solveStep or submitSolve
+        :param float timeout: Seconds, None waits until finished
+        :return: Status as in getSolveStatus
+        :rtype: dict
+        """
+        try:
+            future = self.solveQueue.future(requestID)
+        except KeyError as e:
+            raise APIError.APIError(str(e))
+        future.wait(timeout)
+        return(future.status())
 
     def wait(self):
         """
         Wait until solve is completed when executed in background.
         """
-        if self.mieThread:
-            self.mieThread.join()
+        self.solveQueue.join()
 
     def isSolved(self):
         """
@@ -320,7 +512,340 @@ class MMPMie(Application):
                  solve has completed when executed in background.
         :rtype: bool
         """
-        return(not self.mieThread.isAlive())
+        return(self.solveQueue.idle())
+
+    def getScatteringAtWavelengths(self, wavelengths, objectID):
+        """
+        Returns scattering data of a solved particle type at an arbitrary
+        vector of wavelengths (nm), interpolated from the cached table on
+        the server side.
+
+        :param wavelengths: Wavelengths in nm inside the solved range
+        :param int objectID: Particle object ID
+        :return: Dict with wavelengths, crossSections (wavelength),
+                 inverseCDF (Row = RV, Column = wavelength) and rvs
+        :rtype: dict
+        """
+        if objectID not in self.mieFiles:
+            raise APIError.APIError('Object %s not solved' % str(objectID))
+        table = mieStorage.interpolateMieTable(self.mieFiles[objectID],
+                                               wavelengths,
+                                               particle_ids=[0])
+        return({'wavelengths': table['wavelengths'],
+                'crossSections': table['crossSections'][0],
+                'inverseCDF': mieStorage.inverseCDFColumns(table),
+                'rvs': table['rvs']})
+
+    def sampleScatteringAngles(self, objectID, wavelengths, rvs=None,
+                               count=None, seed=None):
+        """
+        Samples scattering angles of a solved particle type on the server,
+        so a ray batch needs one small call instead of the whole inverse
+        CDF table. Values are interpolated in both wavelength and RV.
+
+        :param int objectID: Particle object ID
+        :param wavelengths: Wavelength (nm) of each ray, or one for all
+        :param rvs: Uniform random numbers in [0, 1], one per ray
+        :param int count: Number of rays when rvs are drawn on the server
+        :param int seed: Seed of the server side random numbers
+        :return: Scattering angles in degrees
+        :rtype: numpy.ndarray
+        """
+        with self._tableLock:
+            if objectID not in self.samplers:
+                raise APIError.APIError('Object %s not solved' %
+                                        str(objectID))
+            sampler = self.samplers[objectID]
+        if rvs is None:
+            if count is None:
+                count = np.size(wavelengths)
+            rvs = uniformRVs(count, seed)
+        try:
+            angles = sampler.sample(wavelengths, rvs)
+        except ValueError as e:
+            raise APIError.APIError(str(e))
+        telemetry.count('sampledAngles', len(angles))
+        return(angles)
+
+    def setApproximateMode(self, max_distance=None):
+        """
+        Enables approximate serving. On a cache miss the closest cached
+        table within max_distance in parameter space is published
+        immediately and the exact table is generated in background.
+
+        :param float max_distance: Max euclidean distance over (n_particle
+               real and imaginary, n_host, mu, sigma). None disables.
+        """
+        self.approximateDistance = max_distance
+
+    def setProgressiveMode(self, coarse_factor=10, coarse_rv_n=1001):
+        """
+        Enables progressive serving. On a cache miss a coarse table is
+        generated first, interpolated onto the requested grids and
+        published with quality 'coarse'. The full table is generated in
+        background, reusing the Mie kernels of the coarse table, and
+        replaces it when done.
+
+        :param int coarse_factor: Max stride of the coarse wavelength
+               grid. The coarse grid is a subset of the full grid. None
+               disables progressive mode.
+        :param int coarse_rv_n: Number of RVs of the coarse table
+        """
+        if coarse_factor is None:
+            self.progressive = None
+        else:
+            self.progressive = {'coarse_factor': int(coarse_factor),
+                                'coarse_rv_n': int(coarse_rv_n)}
+
+    def setPrecision(self, precision='float64'):
+        """
+        Sets the precision of the inverse CDF of the following solves.
+        With float32 or uint16 new tables are stored in that precision,
+        the published inverse CDF is float32 (half the memory) and bulk
+        transfers send it in that precision. uint16 is fixed point over
+        0 - 180 degrees with a max error of 0.0014 degrees.
+
+        :param str precision: float64 (default), float32 or uint16
+        """
+        if precision not in mieStorage.PRECISIONS:
+            raise APIError.APIError('Unknown precision %s' % str(precision))
+        self.precision = precision
+
+    def setSampling(self, sampling='inverseCDF'):
+        """
+        Sets the sampling representation of new tables. With 'alias'
+        tables also store per wavelength Walker alias tables over the
+        angle bins, and sampleScatteringAngles samples them in O(1)
+        with linear sampling inside the bins. Alias tables take about
+        2 kB per wavelength compared to 80 kB of a 10000 RV inverse CDF,
+        so the inverse CDF can be kept coarse with setResolution(rv_n=...).
+
+        :param str sampling: inverseCDF (default) or alias
+        """
+        if sampling not in ('inverseCDF', 'alias'):
+            raise APIError.APIError('Unknown sampling %s' % str(sampling))
+        self.sampling = sampling
+
+    def setRVTolerance(self, tolerance=None):
+        """
+        Stores the inverse CDF of new tables on an adaptive, non-uniform
+        RV grid with nodes where the inverse CDF is curved, reproducing
+        the full grid within tolerance degrees. sampleScatteringAngles
+        samples the adaptive grid directly; the published property is
+        interpolated onto the uniform grid for clients that index it.
+
+        :param float tolerance: Max error in degrees, None disables
+        """
+        self.rvTolerance = tolerance
+
+    def setPhaseFit(self, model=None):
+        """
+        Fits a parametric phase function to every wavelength of new
+        tables and publishes it next to the inverse CDF, so ray tracers
+        can sample analytically and transfer kilobytes instead of the
+        whole table:
+
+        * PID_PhaseFitParameters: Row = parameter, Column = wavelength.
+          hgN gives (weight, g) of N Henyey-Greenstein lobes, legendreN
+          the Legendre moments chi_0 ... chi_N-1.
+        * PID_PhaseFitError: Max difference between the cumulative
+          distributions of the fit and the Mie phase function
+        * PID_AsymmetryFactor: Asymmetry factor g of the Mie solution
+
+        :param str model: e.g. hg2, hg3 or legendre16. None disables.
+        """
+        if model is not None:
+            try:
+                phaseFit.parseModel(model)
+            except ValueError as e:
+                raise APIError.APIError(str(e))
+        self.phaseFit = model
+
+    def setRegimeTolerance(self, tolerance=None):
+        """
+        Lets new tables use approximations instead of the full Mie
+        solution where their estimated error stays within tolerance:
+        the Rayleigh limit for small particles and Fraunhofer
+        diffraction plus geometric optics (anomalous diffraction
+        extinction) for large particles, which take constant time
+        whatever the size. The number of kernels of each regime is
+        logged and counted in getTelemetry.
+
+        :param float tolerance: Relative accuracy, e.g. 0.05. None
+               (default) always uses the full Mie solution.
+        """
+        if tolerance is not None and not tolerance > 0:
+            raise APIError.APIError('Tolerance must be positive')
+        self.regimeTolerance = tolerance
+
+    def setIndexStep(self, step=None):
+        """
+        Rounds refractive indices to multiples of step before new tables
+        are calculated. The PID_RefractiveIndex of a particle type or of
+        OBJ_CONE can be a dispersion model instead of a constant (see
+        refractiveIndex.parseIndex), e.g. {'model': 'sellmeier',
+        'B': [...], 'C': [...]} or a table of (wavelengths in nm, n, k)
+        rows, and each wavelength is calculated at its own index. With
+        a step, tables of nearby dispersion curves share the Mie kernels
+        of the wavelengths where their rounded indices agree.
+
+        :param float step: Index step, e.g. 1e-4. None (default) uses
+               the indices as such.
+        """
+        if step is not None and not step > 0:
+            raise APIError.APIError('Index step must be positive')
+        self.indexStep = step
+
+    def setSpectralBands(self, n_bins=None):
+        """
+        Publishes tables averaged over spectral bands of the LED
+        spectrum instead of every wavelength. The spectrum is the
+        PID_LEDSpectrum property of OBJ_LED, (wavelengths in nm,
+        intensities) as two rows or columns or a dict of wavelengths and
+        intensities. Bands carry equal power, so the bands are narrow
+        where the LED emits most. The spectrum weighted cross section is
+        preserved and the inverse CDF of a band is that of its
+        scattering weighted phase function mixture.
+
+        The band wavelengths (power weighted centroids), edges and power
+        fractions are published as PID_SpectralBands (Row = centroid,
+        lower edge, upper edge, power; Column = band). A changed
+        spectrum is applied on the next solveStep. Without a spectrum
+        the full tables are published.
+
+        :param int n_bins: Max number of bands, None disables
+        """
+        if n_bins is not None and int(n_bins) < 1:
+            raise APIError.APIError('At least one band is needed')
+        self.spectralBins = None if n_bins is None else int(n_bins)
+
+    def setResolution(self, profile='standard', **overrides):
+        """
+        Sets the grid sizes of the Mie tables of the following solves.
+        Tables of different resolution are cached separately, so fast
+        coupling iterations can use the draft profile and final runs the
+        production profile. The wavelength grid of the ray tracer must
+        follow wavelen_n.
+
+        :param str profile: draft, standard (default) or production
+        :param overrides: Single grid sizes: wavelen_n, particle_n,
+               theta_n (scattering angles) or rv_n (RVs of the inverse CDF)
+        :return: The resolution in use
+        :rtype: dict
+        """
+        try:
+            resolution = mieDatabase.resolutionProfile(profile, **overrides)
+        except ValueError as e:
+            raise APIError.APIError(str(e))
+        unknown = set(resolution) - set(mieDatabase.profiles['standard'])
+        if unknown:
+            raise APIError.APIError('Unknown grid sizes %s' %
+                                    ', '.join(sorted(unknown)))
+        self.resolution = resolution
+        return(self.getResolution())
+
+    def getResolution(self):
+        """
+        :return: Grid sizes of the Mie tables (wavelen_n, particle_n,
+                 theta_n, rv_n). theta_n and rv_n of None are the
+                 defaults of the generator.
+        :rtype: dict
+        """
+        return(dict(self.resolution))
+
+    def getTableInfo(self, objectID):
+        """
+        :param int objectID: Particle object ID
+        :return: Status of the published table: filename, approximate
+                 (bool), distance to the requested parameters and quality
+                 (full, nearest or coarse)
+        :rtype: dict
+        """
+        with self._tableLock:
+            if objectID not in self.tableInfo:
+                raise APIError.APIError('Object %s not solved' %
+                                        str(objectID))
+            info = dict(self.tableInfo[objectID])
+            info['exactPending'] = objectID in self._exactParams
+        return(info)
+
+    def getTelemetry(self):
+        """
+        Cache and generation telemetry: lookups, hits and misses,
+        generation count and wall time, kernel tasks per second, bytes
+        read and memory of the kernel cache and published tables.
+
+        :return: Telemetry snapshot
+        :rtype: dict
+        """
+        snap = telemetry.snapshot()
+        snap['gauges']['tableMemoryBytes'] = self._tableMemory()
+        return(snap)
+
+    def setTelemetryDump(self, fname=None, interval=60.0):
+        """
+        Appends a telemetry snapshot as a JSON line to fname every
+        interval seconds. None stops dumping.
+
+        :param str fname: JSON-lines file
+        :param float interval: Seconds between snapshots
+        """
+        if fname is None:
+            telemetry.stopPeriodicDump()
+        else:
+            telemetry.startPeriodicDump(
+                fname, interval,
+                extra=lambda: {'tableMemoryBytes': self._tableMemory()})
+
+    def openArrayTransfer(self, propID, objectID=0, client_host=None,
+                          compression='zlib', chunk_bytes=8 * 1024 * 1024,
+                          precision=None):
+        """
+        Opens a bulk transfer of the value of an array property (for
+        example PID_InverseCumulativeDist) instead of pickling it in one
+        Pyro call. A client on the same host (client_host equal to the
+        host name of the server) gets the path of a .npy file to map,
+        others read compressed chunks with readArrayChunk. Close the
+        transfer with closeArrayTransfer. See arrayTransport.fetchArray.
+
+        :param PropertyID propID: Property ID
+        :param int objectID: Object ID
+        :param str client_host: Host name of the client
+        :param str compression: 'zlib' (lossless) or None
+        :param int chunk_bytes: Raw bytes per chunk
+        :param str precision: float32 or uint16 sends the inverse CDF in
+               a compact precision (see setPrecision). None uses the
+               precision set with setPrecision.
+        :return: Header: transferID, dtype, shape and either path or
+                 compression, precision and nChunks
+        :rtype: dict
+        """
+        value = np.asarray(self.getProperty(propID, 0, objectID).getValue())
+        if propID != PropertyID.PID_InverseCumulativeDist:
+            precision = None
+        elif precision is None and self.precision != 'float64':
+            precision = self.precision
+        header = self.transfers.open(value, client_host, chunk_bytes,
+                                     compression, precision)
+        telemetry.count('arrayTransfers')
+        telemetry.count('arrayTransferBytes', value.nbytes)
+        return(header)
+
+    def readArrayChunk(self, transferID, index):
+        """
+        :return: Chunk index of an open array transfer
+        :rtype: bytes
+        """
+        try:
+            return(self.transfers.chunk(transferID, index))
+        except KeyError as e:
+            raise APIError.APIError(str(e))
+
+    def closeArrayTransfer(self, transferID):
+        """
+        Releases an array transfer.
+        """
+        self.transfers.close(transferID)
 
     def getApplicationSignature(self):
         """
@@ -342,22 +867,76 @@ class MMPMie(Application):
         """
         Terminates the application.
         """
+        self.transfers.clear()
         if self.pyroDaemon:
             self.pyroDaemon.shutdown()
 
-    def _startMieProcess(self, **kwargs):
-
-        tstep = kwargs['tstep']
+    def _tableMemory(self):
+        with self._tableLock:
+            return(sum([np.asarray(self.properties[
+                (pid, objectID, 0)].getValue()).nbytes
+                for objectID in self.mieFiles
+                for pid in (PropertyID.PID_ScatteringCrossSections,
+                            PropertyID.PID_InverseCumulativeDist)]))
+
+    def _timedMieProcess(self, jobs, **kwargs):
+        try:
+            with telemetry.timer('solveStep'):
+                return(self._startMieProcess(jobs=jobs, **kwargs))
+        except Exception:
+            # Failed types are solved again on the next request
+            with self._tableLock:
+                for (objectID, params) in jobs.items():
+                    if self._requested.get(objectID) == _fingerprint(params):
+                        self._requested[objectID] = \
+                            self._fingerprints.get(objectID)
+                if self._bandRequested == kwargs.get('bands'):
+                    self._bandRequested = self._bandFingerprint
+            raise
+
+    def _storageParams(self):
+        """
+        Storage settings of new tables. They are part of the job
+        parameters, so a changed setting solves the particle types
+        again on the next solveStep.
+        """
+        return({'precision': self.precision,
+                'sampling': self.sampling,
+                'rvTolerance': self.rvTolerance,
+                'phaseFit': self.phaseFit,
+                'regimeTolerance': self.regimeTolerance,
+                'indexStep': self.indexStep})
+
+    def _database(self, storage=None):
+        """
+        Mie database connection, one per thread.
 
+        :param dict storage: _storageParams of a job, default the
+               current settings
+        """
+        if storage is None:
+            storage = self._storageParams()
+        return(mieDatabase.MieDatabase(
+            precision=storage['precision'],
+            sampling=storage['sampling'],
+            rv_tolerance=storage['rvTolerance'],
+            phase_fit=storage['phaseFit'],
+            regime_tolerance=storage['regimeTolerance'],
+            index_step=storage['indexStep']))
+
+    def _gridParams(self):
+        """
+        Grid parameters of mieParameters used by solveStep.
+        """
         # parameters moved from solveStep() to here: (MiM)
         # p* and w* are constant, make sure mmpraytracer.py has the same w* !
         p_max = 35.0
         p_min = 1.0#3.0
-        p_num = 50#10
+        p_num = self.resolution['particle_n']
 
         w_max = 1100.0
         w_min = 100.0
-        w_num = 1001#10
+        w_num = self.resolution['wavelen_n']
         """
         p_max = self.getProperty(PropertyID.PID_Particle_max, 0, objID.PARTICLE_TYPE_1).getValue()
         p_min = self.getProperty(PropertyID.PID_Particle_min, 0, prop.getObjectID()).getValue()
@@ -367,6 +946,24 @@ class MMPMie(Application):
                     w_num = self.getProperty(PropertyID.PID_Wavelen_n, 0, prop.getObjectID()).getValue()
         """
 
+        return({'wavelen_n': w_num,
+                'wavelen_max': w_max,
+                'wavelen_min': w_min,
+                'particle_n': p_num,
+                'particle_max': p_max,
+                'particle_min': p_min,
+                'theta_n': self.resolution['theta_n'],
+                'rv_n': self.resolution['rv_n']})
+
+    def _collectJobs(self, tstep):
+        """
+        Collects the Mie parameters of every particle type from the
+        properties.
+
+        :return: Parameters of mieParameters for each particle object ID
+        :rtype: dict
+        """
+
         # Host medium refractive index
         #key = (PropertyID.PID_RefractiveIndex, objID.OBJ_CONE, tstep)
         #key = (PropertyID.PID_RefractiveIndex, 0, objID.OBJ_CONE)
@@ -376,15 +973,14 @@ class MMPMie(Application):
 
         #waves = np.linspace(w_min, w_max, w_num)
 
-        if PropertyID.PID_RefractiveIndex in\
-                self.properties.index.get_level_values('propertyID'):
-
-            pris = self.properties.xs(
-                (PropertyID.PID_RefractiveIndex, 0),
-                level=('propertyID', 'tstep'))
+        jobs = {}
+        if self.properties.contains('propertyID',
+                                    PropertyID.PID_RefractiveIndex):
 
+            pris = self.properties.select(
+                propertyID=PropertyID.PID_RefractiveIndex, tstep=0)
 
-            for i, prop in pris.iteritems():
+            for prop in pris.values():
 
                 if prop.getObjectID() is not objID.OBJ_CONE:
                     # Particle refractive index
@@ -411,36 +1007,423 @@ class MMPMie(Application):
                               'particle_mu': mu,
                               'particle_sigma': sigma,
                               'force_new': False,
-                              'effective_model': True,
-                              'wavelen_n': w_num,
-                              'wavelen_max': w_max,
-                              'wavelen_min': w_min,
-                              'particle_n': p_num,
-                              'particle_max': p_max,
-                              'particle_min': p_min
+                              'effective_model': True
                               }
+                    params.update(self._gridParams())
+                    params['storage'] = self._storageParams()
+                    self._checkIndices(params)
 
-                    ######
+                    jobs[prop.getObjectID()] = params
 
-                    # Mie database
-                    mieDB = mieDatabase.MieDatabase()
-                    # Get parameters
-                    fname = mieDB.mieParameters(**params)  # **kwargs)
-                    # Reload parameters to file
-                    f = h5py.File(fname, 'r')
-                    self.wavelengths = f['wavelengths'][:]
-                    self.crossSections = f['particleData'][
-                        '0']['crossSections'][:]
-                    self.invCDF = f['particleData']['0']['inverseCDF'][:]
+        return(jobs)
 
-                    key = (PropertyID.PID_ScatteringCrossSections,
-                           prop.getObjectID(),
-                           0)
+    def _batchParams(self, param_sets):
+        """
+        Completes the parameter sets of a batch with the default grid.
+        """
+        batch = []
+        for ps in param_sets:
+            if 'n_particle' not in ps or 'n_host' not in ps:
+                raise APIError.APIError('Parameter set without n_particle '
+                                        'or n_host: %s' % str(ps))
+            self._checkIndices(ps)
+            params = self._gridParams()
+            params.update({'force_new': False, 'effective_model': True})
+            params.update(ps)
+            params['storage'] = self._storageParams()
+            batch.append(params)
+        return(batch)
+
+    def _tableParams(self, params):
+        """
+        Job parameters without the storage settings, the keyword
+        arguments of mieParameters.
+        """
+        return(dict((k, v) for (k, v) in params.items() if k != 'storage'))
 
-                    self.properties[key].value = self.crossSections
+    def _checkIndices(self, params):
+        """
+        Raises APIError for refractive indices that are neither
+        constants nor valid dispersion models.
+        """
+        for name in ('n_particle', 'n_host'):
+            try:
+                refractiveIndex.parseIndex(params[name])
+            except (ValueError, TypeError) as e:
+                raise APIError.APIError('Bad %s: %s' % (name, str(e)))
+
+    def _solveBatch(self, jobs, include_data=True):
+        order = sorted(jobs.keys())
+        # Sets of a batch share the settings at submission
+        storage = (jobs[order[0]]['storage'] if order else
+                   self._storageParams())
+        with telemetry.timer('solveBatch'):
+            mieDB = self._database(storage)
+            fnames = mieDB.mieParametersMany([self._tableParams(jobs[i])
+                                              for i in order])
+        telemetry.count('batchSets', len(order))
+        results = []
+        for fname in fnames:
+            result = {'filename': fname}
+            if include_data:
+                table = mieStorage.loadMieTable(fname, particle_ids=[0])
+                result.update({
+                    'wavelengths': table['wavelengths'],
+                    'crossSections': table['crossSections'][0],
+                    'inverseCDF': mieStorage.inverseCDFColumns(table),
+                    'rvs': table['rvs']})
+                if 'phaseFit' in table:
+                    fit = table['phaseFit']
+                    result['phaseFit'] = {
+                        'model': fit['model'],
+                        'parameters': fit['parameters'][0].T,
+                        'error': fit['error'][0],
+                        'asymmetry': fit['asymmetry'][0]}
+                if storage['precision'] != 'float64':
+                    result['inverseCDF'] = \
+                        result['inverseCDF'].astype(np.float32)
+            results.append(result)
+        return(results)
+
+    def _changedJobs(self, jobs):
+        """
+        Drops the particle types whose inputs are unchanged since their
+        latest solve request.
+        """
+        with self._tableLock:
+            return(dict((objectID, params)
+                        for (objectID, params) in jobs.items()
+                        if self._requested.get(objectID) !=
+                        _fingerprint(params)))
 
-                    key = (PropertyID.PID_InverseCumulativeDist,
-                           prop.getObjectID(),
-                           0)
+    def _startMieProcess(self, **kwargs):
+        if 'jobs' in kwargs:
+            jobs = kwargs['jobs']
+        else:
+            jobs = self._changedJobs(self._collectJobs(kwargs['tstep']))
+
+        # Solve particle types concurrently, publish when all are done
+        results = self._solveParticleTypes(jobs)
+        banded = dict([(objectID, self._bandAverage(result[1]))
+                       for (objectID, result) in results.items()])
+        with self._tableLock:
+            for (objectID, result) in results.items():
+                (fname, table, approximate, distance, quality) = result
+                if not approximate:
+                    # Supersedes any exact generation still running
+                    self._exactParams.pop(objectID, None)
+                self._publishTable(objectID, fname, approximate, distance,
+                                   banded[objectID], quality, banded=True,
+                                   params=jobs[objectID])
+                self._fingerprints[objectID] = _fingerprint(jobs[objectID])
+        bands = kwargs.get('bands')
+        if bands is not None and bands != self._bandFingerprint:
+            self._updateBands(bands, skip=results)
+        for (objectID, result) in results.items():
+            if result[2]:
+                self._startExactGeneration(objectID, jobs[objectID])
+        return(sorted(results.keys()))
+
+    def _solveParticleTypes(self, jobs):
+        """
+        Solves the Mie tables of several particle types concurrently.
+        Types with identical parameters are solved once. Generation of
+        all types shares the worker pool of the generator.
 
-                    self.properties[key].value = self.invCDF
+        :param dict jobs: Parameters of mieParameters for each object ID
+        :return: (filename, table, approximate, distance) for each object ID
+        :rtype: dict
+        """
+        groups = {}
+        for (objectID, params) in jobs.items():
+            groups.setdefault(_fingerprint(params), []).append(objectID)
+
+        solved = {}
+        errors = []
+
+        def solve(group):
+            try:
+                solved[group] = self._solveParams(jobs[groups[group][0]])
+            except Exception as e:
+                logger.exception('Solving Mie parameters failed')
+                errors.append(e)
+
+        threads = [threading.Thread(target=solve, args=(group,))
+                   for group in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        results = {}
+        for (group, objectIDs) in groups.items():
+            for objectID in objectIDs:
+                results[objectID] = solved[group]
+        return(results)
+
+    def _solveParams(self, params):
+        """
+        Looks up (or generates) the Mie table of one parameter set and
+        loads it. On a miss approximate mode returns the nearest cached
+        table and progressive mode a coarse table instead.
+        """
+        # Mie database, one connection per thread
+        mieDB = self._database(params.get('storage'))
+        params = self._tableParams(params)
+        fname = None
+        if self.approximateDistance is not None or self.progressive:
+            fname = mieDB.cachedMieParameters(**params)
+        if fname is None and self.approximateDistance is not None:
+            nearest = mieDB.nearestMieParameters(
+                max_distance=self.approximateDistance, **params)
+            if nearest is not None:
+                table = mieStorage.loadMieTable(nearest[0],
+                                                particle_ids=[0])
+                return((nearest[0], table, True, nearest[1], 'nearest'))
+        if fname is None and self.progressive:
+            return(self._coarseTable(mieDB, params))
+        if fname is None:
+            # Get parameters
+            fname = mieDB.mieParameters(**params)  # **kwargs)
+        table = mieStorage.loadMieTable(fname, particle_ids=[0])
+        return((fname, table, False, 0.0, 'full'))
+
+    def _coarseTable(self, mieDB, params):
+        """
+        Generates a coarse table whose wavelengths are a strided subset
+        of the requested grid, so the Mie kernels are reused by the full
+        generation. The table is interpolated onto the requested
+        wavelengths and RVs.
+        """
+        intervals = params['wavelen_n'] - 1
+        stride = max([s for s in range(1, self.progressive['coarse_factor']
+                                       + 1) if intervals % s == 0])
+        coarse = dict(params)
+        coarse['wavelen_n'] = intervals // stride + 1
+        coarse['rv_n'] = self.progressive['coarse_rv_n']
+        fname = mieDB.mieParameters(**coarse)
+
+        waves = np.linspace(params['wavelen_min'], params['wavelen_max'],
+                            params['wavelen_n'])
+        rv_n = params.get('rv_n') or mieDatabase.defaultResolution[
+            bool(params['effective_model'])][1]
+        table = mieStorage.interpolateMieTable(fname, waves,
+                                               particle_ids=[0])
+        table = mieStorage.resampleRVs(table, np.linspace(0, 1, rv_n))
+        telemetry.count('coarseTables')
+        return((fname, table, True, 0.0, 'coarse'))
+
+    def _publishTable(self, objectID, fname, approximate=False,
+                      distance=0.0, table=None, quality='full',
+                      banded=False, params=None):
+        """
+        Sets a Mie table to the scattering properties of the given
+        particle object ID. The table is loaded from fname if not given
+        and band averaged unless banded. The precision and RV count are
+        those of the job params of the table, the current settings if
+        None.
+        """
+        if params is None:
+            params = {'storage': self._storageParams(),
+                      'rv_n': self.resolution['rv_n']}
+        if table is None:
+            # Reload parameters from file (legacy or chunked)
+            table = mieStorage.loadMieTable(fname, particle_ids=[0])
+        if not banded:
+            table = self._bandAverage(table)
+        with self._tableLock:
+            self.mieFiles[objectID] = fname
+            self.tableInfo[objectID] = {'filename': fname,
+                                        'approximate': approximate,
+                                        'distance': distance,
+                                        'quality': quality}
+            self._publishedJobs[objectID] = params
+            self.wavelengths = table['wavelengths']
+            self.crossSections = table['crossSections'][0]
+            sampled = table
+            if not mieStorage.isUniformGrid(table['rvs']):
+                # Clients index the property with a uniform RV grid
+                rv_n = (params.get('rv_n') or
+                        mieDatabase.defaultResolution[True][1])
+                table = mieStorage.resampleRVs(table,
+                                               np.linspace(0, 1, rv_n))
+            self.invCDF = mieStorage.inverseCDFColumns(table)
+            if params['storage']['precision'] != 'float64':
+                self.invCDF = self.invCDF.astype(np.float32)
+            if 'alias' in sampled:
+                self.samplers[objectID] = AliasSampler.fromTable(sampled)
+            elif sampled is not table:
+                # Adaptive grid, sampled directly
+                self.samplers[objectID] = InverseCDFSampler.fromTable(
+                    sampled)
+            else:
+                # Shares the published array
+                self.samplers[objectID] = InverseCDFSampler(
+                    self.wavelengths, self.invCDF.T, table['rvs'])
+
+            key = (PropertyID.PID_ScatteringCrossSections, objectID, 0)
+            self.properties[key].value = self.crossSections
+
+            key = (PropertyID.PID_InverseCumulativeDist, objectID, 0)
+            self.properties[key].value = self.invCDF
+
+            self._publishPhaseFit(objectID, sampled.get('phaseFit'))
+            bands = {}
+            if 'bands' in sampled:
+                bands[PropertyID.PID_SpectralBands] = \
+                    np.ascontiguousarray(sampled['bands'].T)
+            self._setTableProperties(objectID, bands,
+                                     [PropertyID.PID_SpectralBands])
+
+    def _ledSpectrum(self):
+        """
+        (wavelengths, intensities) of the latest PID_LEDSpectrum property
+        of OBJ_LED, or None if spectral bands are disabled or there is
+        no spectrum.
+        """
+        if self.spectralBins is None:
+            return(None)
+        props = self.properties.select(
+            propertyID=PropertyID.PID_LEDSpectrum, objectID=objID.OBJ_LED)
+        if not props:
+            return(None)
+        value = props[max(props.keys(), key=lambda k: k[2])].getValue()
+        if isinstance(value, dict):
+            return((np.asarray(value['wavelengths'], dtype=float),
+                    np.asarray(value['intensities'], dtype=float)))
+        value = np.asarray(value, dtype=float)
+        if value.shape[0] != 2:
+            value = value.T
+        return((value[0], value[1]))
+
+    def _bandAverage(self, table):
+        """
+        Table averaged over the spectral bands of the LED spectrum, the
+        table itself if spectral bands are disabled.
+        """
+        spectrum = self._ledSpectrum()
+        if spectrum is None:
+            return(table)
+        try:
+            return(mieStorage.bandAverageTable(
+                table, spectrum[0], spectrum[1], self.spectralBins))
+        except ValueError as e:
+            raise APIError.APIError(str(e))
+
+    def _bandKey(self):
+        """
+        Fingerprint of the spectral bands and the LED spectrum.
+        """
+        return(_fingerprint({'bins': self.spectralBins,
+                             'spectrum': self._ledSpectrum()}))
+
+    def _updateBands(self, key, skip=()):
+        """
+        Publishes the solved particle types again for the bands of
+        fingerprint key. Types in skip were just published and coarse
+        tables are about to be replaced. The tables are reloaded outside
+        the table lock and key is recorded only after all types were
+        published, so a failed update is retried by the next request.
+        """
+        with self._tableLock:
+            infos = [(objectID, dict(info), self._publishedJobs[objectID])
+                     for (objectID, info) in self.tableInfo.items()
+                     if objectID not in skip and info['quality'] != 'coarse']
+        for (objectID, info, params) in infos:
+            table = self._bandAverage(mieStorage.loadMieTable(
+                info['filename'], particle_ids=[0]))
+            with self._tableLock:
+                if self.tableInfo.get(objectID) != info:
+                    # Replaced by a newer table meanwhile
+                    continue
+                self._publishTable(objectID, info['filename'],
+                                   info['approximate'], info['distance'],
+                                   table, info['quality'], banded=True,
+                                   params=params)
+        with self._tableLock:
+            self._bandFingerprint = key
+
+    def _publishPhaseFit(self, objectID, fit):
+        """
+        Sets the phase function fit properties of a particle object ID.
+        Tables without a fit remove them.
+        """
+        values = {}
+        if fit is not None:
+            values = {PropertyID.PID_PhaseFitParameters:
+                      np.ascontiguousarray(fit['parameters'][0].T),
+                      PropertyID.PID_PhaseFitError: fit['error'][0],
+                      PropertyID.PID_AsymmetryFactor: fit['asymmetry'][0]}
+        self._setTableProperties(objectID, values,
+                                 [PropertyID.PID_PhaseFitParameters,
+                                  PropertyID.PID_PhaseFitError,
+                                  PropertyID.PID_AsymmetryFactor])
+
+    def _setTableProperties(self, objectID, values, pids):
+        """
+        Sets the optional table properties pids of a particle object ID
+        to values. Properties without a value are removed.
+        """
+        for pid in pids:
+            key = (pid, objectID, 0)
+            if pid not in values:
+                if key in self.properties:
+                    del self.properties[key]
+            elif key in self.properties:
+                self.properties[key].value = values[pid]
+            else:
+                self.properties[key] = Property(value=values[pid],
+                                                propID=pid,
+                                                valueType=ValueType.Vector,
+                                                time=0.0,
+                                                units=None,
+                                                objectID=objectID)
+
+    def _startExactGeneration(self, objectID, params):
+        """
+        Generates the exact table of an approximately served particle
+        type in background. The result replaces the approximate table
+        unless newer parameters were requested meanwhile.
+        """
+        with self._tableLock:
+            thread = self._exactThreads.get(objectID)
+            fingerprint = _fingerprint(params)
+            if (thread is not None and thread.is_alive() and
+                    self._exactParams.get(objectID) == fingerprint):
+                return
+            self._exactParams[objectID] = fingerprint
+            thread = threading.Thread(target=self._generateExact,
+                                      args=(objectID, params))
+            thread.daemon = True
+            self._exactThreads[objectID] = thread
+        thread.start()
+
+    def _generateExact(self, objectID, params):
+        fingerprint = _fingerprint(params)
+        try:
+            mieDB = self._database(params.get('storage'))
+            fname = mieDB.mieParameters(**self._tableParams(params))
+            table = self._bandAverage(mieStorage.loadMieTable(
+                fname, particle_ids=[0]))
+        except Exception:
+            logger.exception('Exact table for %s failed' % str(objectID))
+            with self._tableLock:
+                if self._exactParams.get(objectID) == fingerprint:
+                    del self._exactParams[objectID]
+                    # The next solveStep solves the params again and
+                    # restarts the exact generation
+                    if self._requested.get(objectID) == fingerprint:
+                        del self._requested[objectID]
+                    if self._fingerprints.get(objectID) == fingerprint:
+                        del self._fingerprints[objectID]
+            return
+        with self._tableLock:
+            if self._exactParams.get(objectID) != fingerprint:
+                logger.info('Exact table for %s superseded' % str(objectID))
+                return
+            del self._exactParams[objectID]
+            self._publishTable(objectID, fname, table=table, banded=True,
+                               params=params)
+        logger.info('Exact table published for %s' % str(objectID))
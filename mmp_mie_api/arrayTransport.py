@@ -0,0 +1,193 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import itertools
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from .mie import mieStorage
+
+# Default size of one chunk of raw array data
+chunkBytes = 8 * 1024 * 1024
+
+
+def hostName():
+    return(socket.gethostname())
+
+
+def encodeChunks(a, chunk_bytes=chunkBytes, compression='zlib', level=1,
+                 precision=None):
+    '''
+    Splits the raw data of array a into chunks of chunk_bytes, each
+    compressed separately with zlib (compression None sends raw bytes).
+    Arrays of angles (degrees) can be sent in a compact precision
+    (float32 or uint16, see mieStorage.PRECISIONS), None sends them as
+    such.
+
+    :return: (header, chunks). The header holds dtype, shape,
+             compression, precision and nChunks.
+    '''
+    if compression not in (None, 'zlib'):
+        raise ValueError('Unknown compression %s' % str(compression))
+    if precision is not None:
+        a = mieStorage.encodeAngles(a, precision)
+    a = np.ascontiguousarray(a)
+    raw = a.tobytes()
+    chunks = []
+    for start in range(0, max(len(raw), 1), chunk_bytes):
+        chunk = raw[start:start + chunk_bytes]
+        if compression == 'zlib':
+            chunk = zlib.compress(chunk, level)
+        chunks.append(chunk)
+    header = {'dtype': a.dtype.str,
+              'shape': tuple(a.shape),
+              'compression': compression,
+              'precision': precision,
+              'nChunks': len(chunks),
+              'nbytes': len(raw)}
+    return(header, chunks)
+
+
+def decodeChunks(header, chunks):
+    '''
+    Array of the chunks produced by encodeChunks.
+    '''
+    if header['compression'] == 'zlib':
+        chunks = [zlib.decompress(chunk) for chunk in chunks]
+    raw = b''.join(chunks)
+    a = np.frombuffer(raw, dtype=np.dtype(header['dtype']))
+    a = a.reshape(header['shape'])
+    if header.get('precision') is not None:
+        a = mieStorage.decodeAngles(a, header['precision'])
+    return(a)
+
+
+class TransferRegistry():
+
+    '''
+    Open array transfers of a server. Clients on another host read the
+    chunks one call at a time; clients on the same host get the path of
+    a .npy file which they map directly. Transfers not closed by the
+    client are dropped after max_age seconds.
+    '''
+
+    def __init__(self, max_age=600.0):
+        self.max_age = max_age
+        self.transfers = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.tmpDir = None
+
+    def open(self, a, client_host=None, chunk_bytes=chunkBytes,
+             compression='zlib', precision=None):
+        '''
+        Opens a transfer of array a. precision applies to chunked
+        transfers only.
+
+        :return: Header with transferID and either path (same host) or
+                 nChunks
+        :rtype: dict
+        '''
+        self.expire()
+        transferID = next(self.ids)
+        if client_host is not None and client_host == hostName():
+            a = np.ascontiguousarray(a)
+            path = os.path.join(self.__tmpDir(), 'array%d.npy' % transferID)
+            np.save(path, a)
+            header = {'dtype': a.dtype.str,
+                      'shape': tuple(a.shape),
+                      'path': path}
+            chunks = []
+        else:
+            (header, chunks) = encodeChunks(a, chunk_bytes, compression,
+                                            precision=precision)
+        header['transferID'] = transferID
+        with self.lock:
+            self.transfers[transferID] = (time.time(), header, chunks)
+        return(dict(header))
+
+    def chunk(self, transferID, index):
+        with self.lock:
+            if transferID not in self.transfers:
+                raise KeyError('Unknown transfer %s' % str(transferID))
+            return(self.transfers[transferID][2][index])
+
+    def close(self, transferID):
+        with self.lock:
+            entry = self.transfers.pop(transferID, None)
+        if entry is not None and 'path' in entry[1]:
+            try:
+                os.remove(entry[1]['path'])
+            except OSError:
+                pass
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            old = [transferID for (transferID, entry)
+                   in self.transfers.items()
+                   if now - entry[0] > self.max_age]
+        for transferID in old:
+            self.close(transferID)
+
+    def clear(self):
+        with self.lock:
+            transferIDs = list(self.transfers.keys())
+        for transferID in transferIDs:
+            self.close(transferID)
+        if self.tmpDir is not None:
+            shutil.rmtree(self.tmpDir, ignore_errors=True)
+            self.tmpDir = None
+
+    def __tmpDir(self):
+        with self.lock:
+            if self.tmpDir is None:
+                self.tmpDir = tempfile.mkdtemp(prefix='mmpmie')
+            return(self.tmpDir)
+
+
+def fetchArray(app, propID, objectID=0, compression='zlib',
+               chunk_bytes=chunkBytes, precision=None):
+    '''
+    Client side fetch of a large array property from an MMPMie
+    application (local or a Pyro proxy). Clients on the server host map
+    a file, others stream compressed chunks over several calls. Compact
+    precisions are decoded transparently.
+    '''
+    header = app.openArrayTransfer(propID, objectID,
+                                   client_host=hostName(),
+                                   compression=compression,
+                                   chunk_bytes=chunk_bytes,
+                                   precision=precision)
+    try:
+        if 'path' in header:
+            a = np.load(header['path'], mmap_mode='r')
+            if os.name == 'nt':
+                # Mapped files can not be removed on Windows
+                a = np.array(a)
+            return(a)
+        chunks = [app.readArrayChunk(header['transferID'], i)
+                  for i in range(header['nChunks'])]
+        return(decodeChunks(header, chunks))
+    finally:
+        app.closeArrayTransfer(header['transferID'])
@@ -40,12 +40,12 @@ def checkRequiredParameters(props, pID=PropertyID):
         PropertyID.PID_ParticleRefractiveIndex = 26
     """
     #print("Property keys:")
-    # for key in props.index:
+    # for key in props.keys():
     #        print(key)
 
     found = True
 
-    if pID.PID_RefractiveIndex not in props.index:
+    if not props.contains('propertyID', pID.PID_RefractiveIndex):
         print("RefractiveIndex not found!")
         found = False
     #ParticleRefractiveIndex not used currently...
@@ -14,37 +14,284 @@
 # limitations under the License.
 #
 
+import errno
+import hashlib
+import json
 import os
+import shutil
 import sqlite3
+import tarfile
+import time
 
 from scipy.stats import lognorm
 
 import numpy as np
 import mieGenerator as mie
+import mieStorage
+import phaseFit
+import refractiveIndex
+import scatteringTools as st
+from telemetry import telemetry
 
 
 fname = 'mie_database.db'
 baseDir = 'MieDataFiles'
+columns = ['n_particle_r', 'n_particle_j', 'n_host', 'particle_mu',
+           'particle_sigma', 'effective_model', 'wavelen_n', 'wavelen_max',
+           'wavelen_min', 'particle_n', 'particle_max', 'particle_min',
+           'filename', 'key_hash', 'table_key']
+
+# Default (theta_n, rv_n) of non-effective and effective tables
+defaultResolution = {False: (90, 1000), True: (91, 10000)}
+
+# Named resolution profiles. theta_n and rv_n of None are the defaults
+# of the table kind.
+profiles = {'draft': {'wavelen_n': 101,
+                      'particle_n': 10,
+                      'theta_n': 31,
+                      'rv_n': 1001},
+            'standard': {'wavelen_n': 1001,
+                         'particle_n': 50,
+                         'theta_n': None,
+                         'rv_n': None},
+            'production': {'wavelen_n': 2001,
+                           'particle_n': 100,
+                           'theta_n': 181,
+                           'rv_n': 20000}}
+
+
+def tableKey(effective_model,
+             n_particle,
+             n_host,
+             distribution,
+             wavelen_n,
+             wavelen_max,
+             wavelen_min,
+             particle_n,
+             particle_max,
+             particle_min,
+             **extra):
+    '''
+    Full parameter key of a mie-data table.
+
+    distribution identifies the particle distribution of effective tables,
+    for example ['lognorm', mu, sigma]. It is ignored for the
+    non-effective model, whose tables do not depend on it.
+    Refractive indices are constants or dispersion models, see
+    refractiveIndex.parseIndex.
+    Extra keyword arguments are added to the key as such.
+    '''
+    key = {'formatVersion': mieStorage.FORMAT_VERSION,
+           'effectiveModel': bool(effective_model),
+           'nParticle': refractiveIndex.indexKey(n_particle),
+           'nHost': refractiveIndex.indexKey(n_host, real=True),
+           'distribution': distribution if effective_model else None,
+           'wavelengths': [float(wavelen_min), float(wavelen_max),
+                           int(wavelen_n)],
+           'particles': [float(particle_min), float(particle_max),
+                         int(particle_n)]}
+    key.update(extra)
+    return(key)
+
+
+def resolutionProfile(name, **overrides):
+    '''
+    Grid sizes (wavelen_n, particle_n, theta_n, rv_n) of a named profile
+    as keyword arguments of mieParameters. Keyword arguments override
+    single values.
+    '''
+    if name not in profiles:
+        raise ValueError('Unknown resolution profile %s, use one of %s' %
+                         (name, ', '.join(sorted(profiles))))
+    resolution = dict(profiles[name])
+    resolution.update(overrides)
+    return(resolution)
+
+
+def _resolution(effective_model, theta_n=None, rv_n=None):
+    '''
+    Number of scattering angles and RVs of a table and the entries of
+    the table key. Only non-default resolutions are added to the key, so
+    the keys of tables generated before profiles stay valid.
+    '''
+    (d_theta, d_rv) = defaultResolution[bool(effective_model)]
+    theta_n = d_theta if theta_n is None else int(theta_n)
+    rv_n = d_rv if rv_n is None else int(rv_n)
+    extra = {}
+    if (theta_n, rv_n) != (d_theta, d_rv):
+        extra = {'thetaN': theta_n, 'rvN': rv_n}
+    return(theta_n, rv_n, extra)
+
+
+def _extendedKey(key):
+    '''
+    True if the key has entries that tables of older versions, stored
+    without a key, can not match.
+    '''
+    return(any([k in key for k in ('thetaN', 'precision', 'sampling',
+                                   'rvTolerance', 'phaseFit',
+                                   'regimeTolerance', 'indexStep')]) or
+           isinstance(key['nParticle'], dict) or
+           isinstance(key['nHost'], dict))
+
+
+def _indexColumns(n_particle, n_host):
+    '''
+    Values of the n_particle_r, n_particle_j and n_host columns, the
+    nominal indices of dispersive materials.
+    '''
+    n_p = refractiveIndex.nominal(n_particle)
+    return([n_p.real, n_p.imag, refractiveIndex.nominal(n_host).real])
+
+
+def keyHash(key):
+    '''
+    Content hash of a table key. Used as the filename of the table.
+    '''
+    text = json.dumps(key, sort_keys=True)
+    return(hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+
+def distributionHash(particle_distribution):
+    '''
+    Hash of normalized particle distribution weights.
+    '''
+    pdf = np.asarray(particle_distribution, dtype=float)
+    pdf = pdf / pdf.sum()
+    return(hashlib.sha1(pdf.tobytes()).hexdigest())
+
+
+def fileChecksum(filename):
+    '''
+    SHA-256 checksum of a file.
+    '''
+    h = hashlib.sha256()
+    f = open(filename, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    f.close()
+    return(h.hexdigest())
+
+
+def _sameTable(key_a, key_b, ignore=()):
+    '''
+    Compares two table keys ignoring the given fields.
+    '''
+    a = dict((k, v) for (k, v) in key_a.items() if k not in ignore)
+    b = dict((k, v) for (k, v) in key_b.items() if k not in ignore)
+    # Round trip so that tuples and lists compare equal
+    return(json.loads(json.dumps(a)) == json.loads(json.dumps(b)))
+
+
+def _alignGrid(cached, requested, tolerance, interpolate=False):
+    '''
+    Locates the requested grid points on a cached grid.
+
+    Returns (lower, upper, fraction) index arrays so that
+    value = (1 - fraction) * cached[lower] + fraction * cached[upper],
+    or None if the cached grid does not cover the requested one.
+    '''
+    cached = np.asarray(cached, dtype=float)
+    requested = np.asarray(requested, dtype=float)
+    if (requested[0] < cached[0] - tolerance or
+            requested[-1] > cached[-1] + tolerance):
+        return(None)
+
+    # Nearest cached point for every requested point
+    upper = np.clip(np.searchsorted(cached, requested), 0, len(cached) - 1)
+    lower = np.clip(upper - 1, 0, len(cached) - 1)
+    nearest = np.where(np.abs(cached[lower] - requested) <=
+                       np.abs(cached[upper] - requested), lower, upper)
+    if np.all(np.abs(cached[nearest] - requested) <= tolerance):
+        return(nearest, nearest, np.zeros(len(requested)))
+
+    if not interpolate or len(cached) < 2:
+        return(None)
+    # Interpolation only from a grid at least as fine as the requested one
+    if len(requested) > 1 and (np.max(np.diff(cached)) >
+                               np.min(np.diff(requested)) + tolerance):
+        return(None)
+    return(mieStorage.wavelengthBrackets(cached, requested))
 
 
 class MieDatabase():
 
-    def __init__(self):
-        pass
+    def __init__(self, compression=None, shuffle=False, data_dir=None,
+                 processes=None, precision='float64',
+                 sampling='inverseCDF', rv_tolerance=None,
+                 phase_fit=None, regime_tolerance=None,
+                 index_step=None):
+        '''
+        compression ('gzip' or 'lzf') and shuffle are optional lossless
+        HDF5 filters used for newly generated files. processes is the
+        number of worker processes of the generator (default one per cpu).
+        precision is the representation of the inverse CDF of new files:
+        float64, float32 or uint16 fixed point (max error 0.0014
+        degrees). With sampling 'alias' new files also store Walker
+        alias tables of the angle densities (see mieSampler.AliasSampler).
+        With rv_tolerance (degrees) the inverse CDF of new files is stored
+        on an adaptive, non-uniform RV grid that reproduces the generated
+        one within the tolerance.
+        With phase_fit (hgN for N Henyey-Greenstein lobes or legendreN
+        for N Legendre moments, see phaseFit) new files also store a
+        parametric fit of the phase function of each wavelength with its
+        fit error and the asymmetry factor.
+        With regime_tolerance (relative accuracy, e.g. 0.05) small and
+        large particles are calculated with the Rayleigh and the
+        diffraction plus geometric optics approximations instead of the
+        full Mie solution, see mieGenerator.scatteringRegime.
+        With index_step (e.g. 1e-4) refractive indices are rounded to
+        multiples of the step before the Mie calculation, so that the
+        tables of nearby dispersion curves share the Mie kernels of each
+        wavelength, see refractiveIndex.quantize.
+        Tables of each precision, sampling, RV tolerance, phase
+        function fit, regime tolerance and index step are cached
+        separately.
+
+        Tables are stored in data_dir (default MieDataFiles) under the
+        content hash of their parameter key, so the directory can be shared
+        by several hosts: a table already written there by another process
+        is used instead of generating it again.
+        '''
+        self.compression = compression
+        self.shuffle = shuffle
+        self.dataDir = data_dir if data_dir is not None else baseDir
+        self.processes = processes
+        if precision not in mieStorage.PRECISIONS:
+            raise ValueError('Unknown precision %s' % str(precision))
+        self.precision = precision
+        if sampling not in ('inverseCDF', 'alias'):
+            raise ValueError('Unknown sampling %s' % str(sampling))
+        self.sampling = sampling
+        self.rvTolerance = rv_tolerance
+        if phase_fit is not None:
+            phaseFit.parseModel(phase_fit)
+        self.phaseFit = phase_fit
+        self.regimeTolerance = regime_tolerance
+        if index_step is not None and not index_step > 0:
+            raise ValueError('Index step must be positive')
+        self.indexStep = index_step
         # os.remove(fname)
-        if not os.path.isdir(baseDir):
-            os.mkdir(baseDir)
-        if not os.path.isfile(fname):
-            self.conn = sqlite3.connect(fname)
-            self.cursor = self.conn.cursor()
-            self.cursor.execute(
-                '''create table data(n_particle_r,n_particle_j,n_host,
-                particle_mu,particle_sigma,effective_model,wavelen_n,
-                wavelen_max,wavelen_min,particle_n,particle_max,
-                particle_min,filename)''')
-        else:
-            self.conn = sqlite3.connect(fname)
-            self.cursor = self.conn.cursor()
+        # Idempotent, so that several threads or processes can open the
+        # database for the first time concurrently
+        try:
+            os.mkdir(self.dataDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(self.dataDir):
+                raise
+        self.conn = sqlite3.connect(fname)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute(
+            '''create table if not exists data(n_particle_r,n_particle_j,
+            n_host,particle_mu,particle_sigma,effective_model,wavelen_n,
+            wavelen_max,wavelen_min,particle_n,particle_max,
+            particle_min,filename,key_hash,table_key)''')
+        # Checksums of table files, valid while mtime and size match
+        self.cursor.execute(
+            '''create table if not exists checksums(filename primary key,
+            mtime,size,sha256)''')
+        self.conn.commit()
+        self.__upgradeDatabase()
 
     def mieParameters(self,
                       n_particle,
@@ -58,7 +305,12 @@ class MieDatabase():
                       wavelen_min=100.0,
                       particle_n=20,
                       particle_max=20.0,
-                      particle_min=1.0):
+                      particle_min=1.0,
+                      allow_subrange=True,
+                      subrange_tolerance=1e-6,
+                      subrange_interpolation=False,
+                      theta_n=None,
+                      rv_n=None):
         '''
         Mie parameters for Log-normally distributed particles.
 
@@ -70,75 +322,43 @@ class MieDatabase():
 
         Particle refractive index can be complex (1.83 + 2j) for example.
         The host material must have real refractive index.
+        Either index can also be a dispersion model (Cauchy, Sellmeier
+        or a table, see refractiveIndex.parseIndex), in which case each
+        wavelength is calculated at its own index.
 
         You can define particles by sizes max-min-n and lognorm parameters
         sigma and mu. The wavelength range can also be defined here max-min-n.
 
         If you want to use effective model, only one particle type is created
 
+        If allow_subrange is set and a cached table with the same optical
+        parameters covers the requested grids, the table is sliced from it
+        without any Mie computation. Grid points must match within
+        subrange_tolerance, or, with subrange_interpolation, the cached
+        wavelength grid must be at least as fine as the requested one and
+        the table is linearly interpolated.
+
+        theta_n and rv_n are the numbers of scattering angles and RVs of
+        the inverse CDF (default 90 and 1000, or 91 and 10000 for the
+        effective model). See resolutionProfile for named grid sizes.
+
         WAVELENGTH in nm!!!
         Particle diameters in um!!!
 
         '''
-        n_r = np.real(n_particle)
-        n_j = np.imag(n_particle)
-        print(n_r, n_j)
-        selectStr = ('select filename from data where ' +
-                     'n_particle_r = ? AND n_particle_j = ? AND n_host = ? ' +
-                     'AND particle_mu=? ' +
-                     'AND particle_sigma=? ' +
-                     'AND effective_model=? ' +
-                     'AND wavelen_n=? AND wavelen_max=? ' +
-                     'AND wavelen_min=? AND particle_n=? ' +
-                     'AND particle_max=? AND particle_min=?')
-        self.cursor.execute(selectStr, [np.real([n_particle])[0],
-                                        np.imag([n_particle])[0],
-                                        n_host,
-                                        particle_mu,
-                                        particle_sigma,
-                                        effective_model,
-                                        wavelen_n,
-                                        wavelen_max,
-                                        wavelen_min,
-                                        particle_n,
-                                        particle_max,
-                                        particle_min])
-        data = self.cursor.fetchall()
-
-        if not data or force_new:
-            print('Generating new mie data')
-            if(not effective_model):
-                filename = self.__generateMie(n_particle,
-                                              n_host,
-                                              particle_mu,
-                                              particle_sigma,
-                                              effective_model,
-                                              wavelen_n,
-                                              wavelen_max,
-                                              wavelen_min,
-                                              particle_n,
-                                              particle_max,
-                                              particle_min)
-            else:
-                filename = self.__generateMieEffective(n_particle,
-                                                       n_host,
-                                                       particle_mu,
-                                                       particle_sigma,
-                                                       effective_model,
-                                                       wavelen_n,
-                                                       wavelen_max,
-                                                       wavelen_min,
-                                                       particle_n,
-                                                       particle_max,
-                                                       particle_min)
-            if not force_new:
-                self.__addMieFile(filename, n_particle, n_host, particle_mu,
-                                  particle_sigma, effective_model, wavelen_n,
-                                  wavelen_max, wavelen_min, particle_n,
-                                  particle_max, particle_min)
-        else:
-            filename = data[0][0]
-        return(filename)
+        (theta_n, rv_n, extra) = _resolution(effective_model, theta_n, rv_n)
+        extra.update(self.__storageKey())
+        key = tableKey(effective_model, n_particle, n_host,
+                       ['lognorm', float(particle_mu), float(particle_sigma)],
+                       wavelen_n, wavelen_max, wavelen_min,
+                       particle_n, particle_max, particle_min, **extra)
+        return(self.__mieParameters(key, n_particle, n_host, particle_mu,
+                                    particle_sigma, None, force_new,
+                                    effective_model, wavelen_n, wavelen_max,
+                                    wavelen_min, particle_n, particle_max,
+                                    particle_min, allow_subrange,
+                                    subrange_tolerance,
+                                    subrange_interpolation, theta_n, rv_n))
 
     def mieParametersArbitrary(self,
                                n_particle,
@@ -153,7 +373,12 @@ class MieDatabase():
                                wavelen_min=100.0,
                                particle_n=20,
                                particle_max=20.0,
-                               particle_min=1.0):
+                               particle_min=1.0,
+                               allow_subrange=True,
+                               subrange_tolerance=1e-6,
+                               subrange_interpolation=False,
+                               theta_n=None,
+                               rv_n=None):
         '''
         Mie parameters for arbitrarily distributed particles.
 
@@ -169,75 +394,425 @@ class MieDatabase():
 
         Particle refractive index can be complex (1.83 + 2j) for example.
         The host material must have real refractive index.
+        Either index can also be a dispersion model (Cauchy, Sellmeier
+        or a table, see refractiveIndex.parseIndex), in which case each
+        wavelength is calculated at its own index.
 
         You can define particles by sizes max-min-n and particle distribution.
         The wavelength range can also be defined here max-min-n.
 
         If you want to use effective model, only one particle type is created
 
+        If allow_subrange is set and a cached table with the same optical
+        parameters covers the requested grids, the table is sliced from it
+        without any Mie computation. Grid points must match within
+        subrange_tolerance, or, with subrange_interpolation, the cached
+        wavelength grid must be at least as fine as the requested one and
+        the table is linearly interpolated.
+
+        theta_n and rv_n are the numbers of scattering angles and RVs of
+        the inverse CDF (default 90 and 1000, or 91 and 10000 for the
+        effective model). See resolutionProfile for named grid sizes.
+
         WAVELENGTH in nm!!!
         Particle diameters in um!!!
 
         '''
-        n_r = np.real(n_particle)
-        n_j = np.imag(n_particle)
+        (theta_n, rv_n, extra) = _resolution(effective_model, theta_n, rv_n)
+        extra.update(self.__storageKey())
+        key = tableKey(effective_model, n_particle, n_host,
+                       ['arbitrary', distributionHash(particle_distribution)],
+                       wavelen_n, wavelen_max, wavelen_min,
+                       particle_n, particle_max, particle_min, **extra)
+        return(self.__mieParameters(key, n_particle, n_host, id_1, id_2,
+                                    particle_distribution, force_new,
+                                    effective_model, wavelen_n, wavelen_max,
+                                    wavelen_min, particle_n, particle_max,
+                                    particle_min, allow_subrange,
+                                    subrange_tolerance,
+                                    subrange_interpolation, theta_n, rv_n))
+
+    def mieParametersMany(self, param_sets):
+        '''
+        Mie parameters for many parameter sets.
+
+        param_sets is a list of keyword dicts of mieParameters (or of
+        mieParametersArbitrary if particle_distribution is given). The sets
+        are processed grouped by optical constants and grids, so that the
+        generator can reuse the Mie kernels of the previous table. Returns
+        the filenames in the order of param_sets.
+        '''
+        def kernelGroup(i):
+            ps = param_sets[i]
+            (n_r, n_j, n_h) = _indexColumns(ps['n_particle'],
+                                            ps['n_host'])
+            return((n_r, n_j, n_h,
+                    bool(ps.get('effective_model', True)),
+                    ps.get('wavelen_n', 1000), ps.get('wavelen_max', 1100.0),
+                    ps.get('wavelen_min', 100.0), ps.get('particle_n', 20),
+                    ps.get('particle_max', 20.0),
+                    ps.get('particle_min', 1.0),
+                    ps.get('theta_n') or 0))
+
+        filenames = [None] * len(param_sets)
+        for i in sorted(range(len(param_sets)), key=kernelGroup):
+            ps = param_sets[i]
+            if 'particle_distribution' in ps:
+                filenames[i] = self.mieParametersArbitrary(**ps)
+            else:
+                filenames[i] = self.mieParameters(**ps)
+        return(filenames)
+
+    def mieParametersAtWavelengths(self, wavelengths, particle_ids=None,
+                                   **kwargs):
+        '''
+        Cross sections and inverse CDF rows at an arbitrary vector of
+        wavelengths (nm).
+
+        The table is looked up (or generated) with mieParameters(**kwargs)
+        and linearly interpolated to the given wavelengths, so the grid of
+        the table does not need to match them. Returns a dict with
+        wavelengths, crossSections (particle, wavelength) and
+        inverseCDF (particle, wavelength, RV).
+        '''
+        filename = self.mieParameters(**kwargs)
+        return(mieStorage.interpolateMieTable(filename, wavelengths,
+                                              particle_ids=particle_ids))
+
+    def mixtureParameters(self, components, generate=False,
+                          force_new=False, **common):
+        '''
+        Effective table of a mixture of particle species, composed from
+        the cached effective tables of the species without any Mie
+        computation.
+
+        components is a list of keyword dicts of mieParameters, one per
+        log-normally distributed species, each with its amount as one of
+        number_density (particles per um^3), volume_fraction, or
+        weight_fraction with density_particle and density_host. Volume
+        and weight fractions are converted to number densities over the
+        particle grid of the species with
+        scatteringTools.particlesInVolumeLogNormTotal and
+        particlesInVolumeLogNormWeightTotal. Keyword arguments in common
+        (grids, for example) apply to every component.
+
+        The tables of the species must be cached (or derivable from
+        cached tables, see cachedMieParameters) and share the wavelength
+        grid. Missing tables raise ValueError, or are generated with
+        generate. See mieStorage.mixTables for the mixing.
+
+        Mixtures are keyed by the checksums of their component files
+        and the number densities, so a regenerated component gives a new
+        mixture. They are registered in the database (without optical
+        constants) and so exported and imported with the other tables.
+
+        Returns (filename, number_density): the mixture table and the
+        total number density (particles per um^3) its cross sections
+        apply to.
+        '''
+        amounts = ('number_density', 'volume_fraction', 'weight_fraction',
+                   'density_particle', 'density_host')
+        fnames = []
+        densities = []
+        for component in components:
+            ps = dict(common)
+            ps.update(component)
+            if 'particle_distribution' in ps:
+                raise ValueError('Mixtures support log-normal species only')
+            if not ps.get('effective_model', True):
+                raise ValueError('Mixtures need effective tables')
+            diameters = np.linspace(ps.get('particle_min', 1.0),
+                                    ps.get('particle_max', 20.0),
+                                    ps.get('particle_n', 20))
+            if 'number_density' in ps:
+                density = float(ps['number_density'])
+            elif 'volume_fraction' in ps:
+                density = st.particlesInVolumeLogNormTotal(
+                    ps['volume_fraction'], ps['particle_mu'],
+                    ps['particle_sigma'], diameters)
+            elif 'weight_fraction' in ps:
+                density = st.particlesInVolumeLogNormWeightTotal(
+                    ps['weight_fraction'], ps['density_particle'],
+                    ps['density_host'], ps['particle_mu'],
+                    ps['particle_sigma'], diameters)
+            else:
+                raise ValueError('Component without number_density, '
+                                 'volume_fraction or weight_fraction')
+            params = dict((k, v) for (k, v) in ps.items()
+                          if k not in amounts)
+            fname = self.cachedMieParameters(**params)
+            if fname is None and generate:
+                params['force_new'] = False
+                fname = self.mieParameters(**params)
+            if fname is None:
+                raise ValueError('No cached table of mixture component '
+                                 'n_particle %s, mu %s, sigma %s' %
+                                 (str(params['n_particle']),
+                                  str(params['particle_mu']),
+                                  str(params['particle_sigma'])))
+            fnames.append(fname)
+            densities.append(float(density))
+
+        key = {'formatVersion': mieStorage.FORMAT_VERSION,
+               'mixture': sorted([[self.__fileChecksum(f), n]
+                                  for (f, n) in zip(fnames, densities)])}
+        if self.precision != 'float64':
+            key['precision'] = self.precision
+        o_f = os.path.join(self.dataDir, 'mie_mix_' + keyHash(key) + '.hdf5')
+        if not force_new:
+            self.cursor.execute('select filename from data ' +
+                                'where key_hash = ?', [keyHash(key)])
+            found = [row[0] for row in self.cursor.fetchall()
+                     if os.path.isfile(row[0])]
+            if not found and os.path.isfile(o_f):
+                # Mixed by another process sharing the data directory
+                self.__addMixtureFile(o_f, key,
+                                      mieStorage.loadMieTable(
+                                          o_f)['wavelengths'])
+                found = [o_f]
+            if found:
+                telemetry.count('mixtureHits')
+                return(found[0], sum(densities))
+
+        print('Mixing mie data of %d species' % len(fnames))
+        tables = [mieStorage.loadMieTable(f, particle_ids=[0])
+                  for f in fnames]
+        mixture = mieStorage.mixTables(tables, densities)
+        mieStorage.saveMieTable(o_f,
+                                wavelengths=mixture['wavelengths'],
+                                particle_diameters=mixture[
+                                    'particleDiameter'],
+                                cross_sections=mixture['crossSections'],
+                                inverse_cdf=mixture['inverseCDF'],
+                                rvs=mixture['rvs'],
+                                compression=self.compression,
+                                shuffle=self.shuffle,
+                                precision=self.precision)
+        self.cursor.execute('delete from data where key_hash = ?',
+                            [keyHash(key)])
+        self.__addMixtureFile(o_f, key, mixture['wavelengths'])
+        telemetry.count('mixtures')
+        return(o_f, mixture['numberDensity'])
+
+    def __mieParameters(self,
+                        key,
+                        n_particle,
+                        n_host,
+                        particle_mu,
+                        particle_sigma,
+                        particle_distribution,
+                        force_new,
+                        effective_model,
+                        wavelen_n,
+                        wavelen_max,
+                        wavelen_min,
+                        particle_n,
+                        particle_max,
+                        particle_min,
+                        allow_subrange,
+                        subrange_tolerance,
+                        subrange_interpolation,
+                        theta_n,
+                        rv_n):
+        '''
+        Private function.
+        Lookup of mie data with the given table key, generates new data
+        on a miss. particle_distribution is None for log-normal
+        distributions (particle_mu and particle_sigma).
+        '''
+        (n_r, n_j) = _indexColumns(n_particle, n_host)[:2]
         print(n_r, n_j)
-        selectStr = ('select filename from data where ' +
-                     'n_particle_r = ? AND n_particle_j = ? AND n_host = ? ' +
-                     'AND particle_mu=? ' +
-                     'AND particle_sigma=? ' +
-                     'AND effective_model=? ' +
-                     'AND wavelen_n=? AND wavelen_max=? ' +
-                     'AND wavelen_min=? AND particle_n=? ' +
-                     'AND particle_max=? AND particle_min=?')
-        self.cursor.execute(selectStr, [np.real([n_particle])[0],
-                                        np.imag([n_particle])[0],
-                                        n_host,
-                                        id_1,
-                                        id_2,
-                                        effective_model,
-                                        wavelen_n,
-                                        wavelen_max,
-                                        wavelen_min,
-                                        particle_n,
-                                        particle_max,
-                                        particle_min])
-        data = self.cursor.fetchall()
+        o_f = self.__tableFile(key)
+        telemetry.count('lookups')
+        data = self.__findMieFile(key, n_particle, n_host, particle_mu,
+                                  particle_sigma, effective_model, wavelen_n,
+                                  wavelen_max, wavelen_min, particle_n,
+                                  particle_max, particle_min)
+        if data:
+            telemetry.count('hits')
+
+        if not data and not force_new and allow_subrange:
+            derived = self.__subrangeTable(n_particle, n_host, particle_mu,
+                                           particle_sigma, effective_model,
+                                           wavelen_n, wavelen_max,
+                                           wavelen_min, particle_n,
+                                           particle_max, particle_min,
+                                           subrange_tolerance,
+                                           subrange_interpolation, key)
+            if derived is not None:
+                telemetry.count('subrangeHits')
+                data = [(derived,)]
+
+        if not data and not force_new and os.path.isfile(o_f):
+            # Generated by another process sharing the data directory
+            print('Found mie data ' + o_f)
+            self.__addMieFile(o_f, n_particle, n_host, particle_mu,
+                              particle_sigma, effective_model, wavelen_n,
+                              wavelen_max, wavelen_min, particle_n,
+                              particle_max, particle_min, key)
+            telemetry.count('sharedHits')
+            data = [(o_f,)]
 
         if not data or force_new:
             print('Generating new mie data')
+            telemetry.count('misses')
+            startTime = time.time()
             if(not effective_model):
-                filename = self.__generateMie(n_particle,
+                filename = self.__generateMie(o_f,
+                                              n_particle,
                                               n_host,
-                                              id_1,
-                                              id_2,
+                                              particle_mu,
+                                              particle_sigma,
                                               effective_model,
                                               wavelen_n,
                                               wavelen_max,
                                               wavelen_min,
                                               particle_n,
                                               particle_max,
-                                              particle_min)
+                                              particle_min,
+                                              theta_n,
+                                              rv_n)
+            elif particle_distribution is None:
+                filename = self.__generateMieEffective(o_f,
+                                                       n_particle,
+                                                       n_host,
+                                                       particle_mu,
+                                                       particle_sigma,
+                                                       effective_model,
+                                                       wavelen_n,
+                                                       wavelen_max,
+                                                       wavelen_min,
+                                                       particle_n,
+                                                       particle_max,
+                                                       particle_min,
+                                                       theta_n,
+                                                       rv_n)
             else:
-                filename = self.__generateMieEffectiveArbitrary(n_particle,
-                                                                n_host,
-                                                                particle_distribution,
-                                                                effective_model,
-                                                                wavelen_n,
-                                                                wavelen_max,
-                                                                wavelen_min,
-                                                                particle_n,
-                                                                particle_max,
-                                                                particle_min)
+                filename = self.__generateMieEffectiveArbitrary(
+                    o_f,
+                    n_particle,
+                    n_host,
+                    particle_distribution,
+                    effective_model,
+                    wavelen_n,
+                    wavelen_max,
+                    wavelen_min,
+                    particle_n,
+                    particle_max,
+                    particle_min,
+                    theta_n,
+                    rv_n)
+            telemetry.addTime('generation', time.time() - startTime)
             if not force_new:
-                self.__addMieFile(filename, n_particle, n_host, id_1,
-                                  id_2, effective_model, wavelen_n,
+                self.__addMieFile(filename, n_particle, n_host, particle_mu,
+                                  particle_sigma, effective_model, wavelen_n,
                                   wavelen_max, wavelen_min, particle_n,
-                                  particle_max, particle_min)
+                                  particle_max, particle_min, key)
         else:
             filename = data[0][0]
         return(filename)
 
+    def exportTables(self, archive_fname, filenames=None):
+        '''
+        Packs tables and their database rows into a portable archive
+        (tar.gz) that can be merged into another database with
+        importTables. filenames selects the tables (default all).
+        Returns the number of exported tables.
+        '''
+        self.cursor.execute('select ' + ','.join(columns) + ' from data')
+        rows = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+        if filenames is not None:
+            rows = [row for row in rows if row['filename'] in filenames]
+
+        manifest = []
+        archive = tarfile.open(archive_fname, 'w:gz')
+        packed = set()
+        for row in rows:
+            if not os.path.isfile(row['filename']):
+                continue
+            name = os.path.basename(row['filename'])
+            if name not in packed:
+                archive.add(row['filename'], arcname='tables/' + name)
+                packed.add(name)
+            entry = dict(row)
+            entry['filename'] = name
+            entry['sha256'] = fileChecksum(row['filename'])
+            manifest.append(entry)
+
+        manifest_fname = archive_fname + '.manifest.json'
+        f = open(manifest_fname, 'w')
+        json.dump({'formatVersion': mieStorage.FORMAT_VERSION,
+                   'tables': manifest}, f, indent=1)
+        f.close()
+        archive.add(manifest_fname, arcname='manifest.json')
+        archive.close()
+        os.remove(manifest_fname)
+        print('Exported %d tables to %s' % (len(manifest), archive_fname))
+        return(len(manifest))
+
+    def importTables(self, archive_fname):
+        '''
+        Merges an archive written by exportTables into this database.
+        Tables whose key is already in the database are skipped, as are
+        rows of older versions without a key that match an existing row
+        by filename and parameters. The checksum of every imported file
+        is verified. A local file of the same name but other content is
+        never replaced, the imported file is stored under a name with
+        its checksum instead. Returns the number of imported tables.
+        '''
+        archive = tarfile.open(archive_fname, 'r:gz')
+        manifest = json.loads(
+            archive.extractfile('manifest.json').read().decode('utf-8'))
+
+        # Parameter columns of rows without a key
+        params = columns[:columns.index('filename')]
+        imported = 0
+        for entry in manifest['tables']:
+            name = os.path.basename(entry['filename'])
+            target = os.path.join(self.dataDir, name)
+            if (os.path.isfile(target) and
+                    fileChecksum(target) != entry['sha256']):
+                # Other content under the same name
+                (stem, ext) = os.path.splitext(name)
+                target = os.path.join(self.dataDir, '%s_%s%s' % (
+                    stem, entry['sha256'][:16], ext))
+            if entry.get('key_hash') is not None:
+                self.cursor.execute('select filename from data ' +
+                                    'where key_hash = ?',
+                                    [entry['key_hash']])
+            else:
+                self.cursor.execute(
+                    'select filename from data where key_hash is null ' +
+                    'AND filename = ? AND ' +
+                    ' AND '.join([c + ' = ?' for c in params]),
+                    [target] + [entry.get(c) for c in params])
+            if self.cursor.fetchall():
+                continue
+            if not (os.path.isfile(target) and
+                    fileChecksum(target) == entry['sha256']):
+                tmp_target = mieStorage._tempName(target)
+                src = archive.extractfile('tables/' + name)
+                dst = open(tmp_target, 'wb')
+                shutil.copyfileobj(src, dst)
+                dst.close()
+                if fileChecksum(tmp_target) != entry['sha256']:
+                    os.remove(tmp_target)
+                    archive.close()
+                    raise ValueError('Checksum mismatch in %s: %s' %
+                                     (archive_fname, name))
+                mieStorage._replaceFile(tmp_target, target)
+            row = dict(entry)
+            row['filename'] = target
+            self.cursor.execute(
+                'insert into data (' + ','.join(columns) + ') values (' +
+                ','.join(['?'] * len(columns)) + ')',
+                [row.get(c) for c in columns])
+            imported += 1
+        self.conn.commit()
+        archive.close()
+        print('Imported %d tables from %s' % (imported, archive_fname))
+        return(imported)
+
     def __addMieFile(self,
                      filename,
                      n_particle,
@@ -250,17 +825,17 @@ class MieDatabase():
                      wavelen_min=100.0,
                      particle_n=20,
                      particle_max=20.0,
-                     particle_min=1.0):
+                     particle_min=1.0,
+                     key=None):
         '''
         Private function.
         Adds mie data filename to database.
         '''
-        self.cursor.execute('''insert into data values (?,?,?,?,?,
-                            ?,?,?,?,?,?,?,?)''',
-                            [np.real([n_particle])[0],
-                             np.imag([n_particle])[0],
-                             n_host,
-                             particle_mu,
+        self.cursor.execute('insert into data (' + ','.join(columns) +
+                            ') values (' + ','.join(['?'] * len(columns)) +
+                            ')',
+                            _indexColumns(n_particle, n_host) +
+                            [particle_mu,
                              particle_sigma,
                              effective_model,
                              wavelen_n,
@@ -269,10 +844,380 @@ class MieDatabase():
                              particle_n,
                              particle_max,
                              particle_min,
-                             filename])
+                             filename,
+                             keyHash(key) if key is not None else None,
+                             json.dumps(key, sort_keys=True)
+                             if key is not None else None])
+        self.conn.commit()
+
+    def __addMixtureFile(self, filename, key, wavelengths):
+        '''
+        Private function.
+        Adds a mixture table to database. Mixtures have no single set of
+        optical constants or particle grid, so those columns are null
+        and only lookups by key hash find them.
+        '''
+        row = dict((c, None) for c in columns)
+        row.update({'effective_model': True,
+                    'wavelen_n': len(wavelengths),
+                    'wavelen_max': float(wavelengths[-1]),
+                    'wavelen_min': float(wavelengths[0]),
+                    'filename': filename,
+                    'key_hash': keyHash(key),
+                    'table_key': json.dumps(key, sort_keys=True)})
+        self.cursor.execute('insert into data (' + ','.join(columns) +
+                            ') values (' + ','.join(['?'] * len(columns)) +
+                            ')', [row[c] for c in columns])
+        self.conn.commit()
+
+    def __fileChecksum(self, filename):
+        '''
+        Private function.
+        fileChecksum of a table file, cached in the database until the
+        modification time or size of the file changes.
+        '''
+        stat = os.stat(filename)
+        self.cursor.execute('select mtime, size, sha256 from checksums ' +
+                            'where filename = ?', [filename])
+        row = self.cursor.fetchone()
+        if row is not None and row[:2] == (stat.st_mtime, stat.st_size):
+            return(row[2])
+        checksum = fileChecksum(filename)
+        self.cursor.execute('insert or replace into checksums ' +
+                            '(filename, mtime, size, sha256) ' +
+                            'values (?, ?, ?, ?)',
+                            [filename, stat.st_mtime, stat.st_size,
+                             checksum])
         self.conn.commit()
+        return(checksum)
+
+    def __upgradeDatabase(self):
+        '''
+        Private function.
+        Adds columns missing from databases of older versions.
+        '''
+        self.cursor.execute('pragma table_info(data)')
+        columns = [row[1] for row in self.cursor.fetchall()]
+        for column in ['key_hash', 'table_key']:
+            if column not in columns:
+                try:
+                    self.cursor.execute('alter table data add column ' +
+                                        column)
+                except sqlite3.OperationalError as e:
+                    # Added meanwhile by another connection
+                    if 'duplicate column' not in str(e):
+                        raise
+        self.conn.commit()
+
+    def __storageKey(self):
+        '''
+        Private function.
+        Key entries of the precision, sampling representation, RV
+        tolerance, phase function fit, regime tolerance and index step.
+        Only non-default values are added, so keys of float64 inverse
+        CDF tables stay as before.
+        '''
+        extra = {}
+        if self.precision != 'float64':
+            extra['precision'] = self.precision
+        if self.sampling != 'inverseCDF':
+            extra['sampling'] = self.sampling
+        if self.rvTolerance is not None:
+            extra['rvTolerance'] = float(self.rvTolerance)
+        if self.phaseFit is not None:
+            extra['phaseFit'] = self.phaseFit
+        if self.regimeTolerance is not None:
+            extra['regimeTolerance'] = float(self.regimeTolerance)
+        if self.indexStep is not None:
+            extra['indexStep'] = float(self.indexStep)
+        return(extra)
+
+    def __opticalConstants(self, n_particle, n_host, wavelengths):
+        '''
+        Private function.
+        Particle and host indices of the generator at wavelengths (nm),
+        one per wavelength for dispersive materials.
+        '''
+        if (self.indexStep is None and
+                not refractiveIndex.isDispersive(n_particle) and
+                not refractiveIndex.isDispersive(n_host)):
+            return(n_particle, n_host)
+        return(refractiveIndex.evaluate(n_particle, wavelengths,
+                                        self.indexStep),
+               refractiveIndex.evaluate(n_host, wavelengths,
+                                        self.indexStep).real)
+
+    def __tableFile(self, key):
+        '''
+        Private function.
+        Content addressed filename of a mie-data file.
+        '''
+        prefix = 'mie_eff_' if key['effectiveModel'] else 'mie_'
+        return(os.path.join(self.dataDir, prefix + keyHash(key) + '.hdf5'))
+
+    def cachedMieParameters(self,
+                            n_particle,
+                            n_host,
+                            particle_mu,
+                            particle_sigma,
+                            effective_model=True,
+                            wavelen_n=1000,
+                            wavelen_max=1100.0,
+                            wavelen_min=100.0,
+                            particle_n=20,
+                            particle_max=20.0,
+                            particle_min=1.0,
+                            allow_subrange=True,
+                            subrange_tolerance=1e-6,
+                            subrange_interpolation=False,
+                            theta_n=None,
+                            rv_n=None,
+                            **kwargs):
+        '''
+        Like mieParameters, but never generates new data. Returns the
+        filename of a cached (or sliced) table or None on a miss.
+        '''
+        extra = _resolution(effective_model, theta_n, rv_n)[2]
+        extra.update(self.__storageKey())
+        key = tableKey(effective_model, n_particle, n_host,
+                       ['lognorm', float(particle_mu), float(particle_sigma)],
+                       wavelen_n, wavelen_max, wavelen_min,
+                       particle_n, particle_max, particle_min, **extra)
+        data = self.__findMieFile(key, n_particle, n_host, particle_mu,
+                                  particle_sigma, effective_model, wavelen_n,
+                                  wavelen_max, wavelen_min, particle_n,
+                                  particle_max, particle_min)
+        if data:
+            return(data[0][0])
+        if allow_subrange:
+            return(self.__subrangeTable(n_particle, n_host, particle_mu,
+                                        particle_sigma, effective_model,
+                                        wavelen_n, wavelen_max, wavelen_min,
+                                        particle_n, particle_max,
+                                        particle_min, subrange_tolerance,
+                                        subrange_interpolation, key))
+        return(None)
+
+    def nearestMieParameters(self,
+                             n_particle,
+                             n_host,
+                             particle_mu,
+                             particle_sigma,
+                             effective_model=True,
+                             wavelen_n=1000,
+                             wavelen_max=1100.0,
+                             wavelen_min=100.0,
+                             particle_n=20,
+                             particle_max=20.0,
+                             particle_min=1.0,
+                             max_distance=np.inf,
+                             theta_n=None,
+                             rv_n=None,
+                             **kwargs):
+        '''
+        Closest cached table in parameter space.
+
+        Only tables with identical grids and resolution are considered.
+        The distance is the euclidean distance over (real and imaginary
+        particle index, host index, mu, sigma), with the nominal indices
+        of dispersive materials (see refractiveIndex.nominal). Returns
+        (filename, distance) of the closest table within max_distance
+        or None.
+        '''
+        selectStr = ('select filename, n_particle_r, n_particle_j, ' +
+                     'n_host, particle_mu, particle_sigma, table_key ' +
+                     'from data where ' +
+                     'effective_model=? ' +
+                     'AND wavelen_n=? AND wavelen_max=? ' +
+                     'AND wavelen_min=? AND particle_n=? ' +
+                     'AND particle_max=? AND particle_min=?')
+        self.cursor.execute(selectStr, [effective_model,
+                                        wavelen_n,
+                                        wavelen_max,
+                                        wavelen_min,
+                                        particle_n,
+                                        particle_max,
+                                        particle_min])
+        target = np.array(_indexColumns(n_particle, n_host) +
+                          [particle_mu, particle_sigma], dtype=float)
+        extra = _resolution(effective_model, theta_n, rv_n)[2]
+        extra.update(self.__storageKey())
+        key = tableKey(effective_model, n_particle, n_host,
+                       ['lognorm', float(particle_mu), float(particle_sigma)],
+                       wavelen_n, wavelen_max, wavelen_min,
+                       particle_n, particle_max, particle_min, **extra)
+        best = None
+        for row in self.cursor.fetchall():
+            if not os.path.isfile(row[0]):
+                continue
+            if row[6] is not None:
+                # Only tables of the same kind of distribution
+                c_key = json.loads(row[6])
+                if (c_key.get('distribution') or [None])[0] != \
+                        (key['distribution'] or [None])[0]:
+                    continue
+                if any([c_key.get(k) != key.get(k)
+                        for k in ('thetaN', 'rvN', 'precision',
+                                  'sampling', 'rvTolerance', 'phaseFit',
+                                  'regimeTolerance', 'indexStep')]):
+                    continue
+            elif extra:
+                # Rows of older versions have the default resolution
+                continue
+            distance = np.sqrt(np.sum(
+                (np.array(row[1:6], dtype=float) - target) ** 2))
+            if distance <= max_distance and (best is None or
+                                             distance < best[1]):
+                best = (row[0], distance)
+        return(best)
+
+    def __findMieFile(self,
+                      key,
+                      n_particle,
+                      n_host,
+                      particle_mu,
+                      particle_sigma,
+                      effective_model,
+                      wavelen_n,
+                      wavelen_max,
+                      wavelen_min,
+                      particle_n,
+                      particle_max,
+                      particle_min):
+        '''
+        Private function.
+        Exact lookup of mie data filenames in database. Rows are matched
+        by key hash; rows of older versions without one by their columns.
+        '''
+        self.cursor.execute('select filename from data where key_hash = ?',
+                            [keyHash(key)])
+        data = self.cursor.fetchall()
+        if data or _extendedKey(key):
+            # Rows of older versions have the default resolution
+            return(data)
+        selectStr = ('select filename from data where key_hash is null ' +
+                     'AND ' +
+                     'n_particle_r = ? AND n_particle_j = ? AND n_host = ? ' +
+                     'AND particle_mu=? ' +
+                     'AND particle_sigma=? ' +
+                     'AND effective_model=? ' +
+                     'AND wavelen_n=? AND wavelen_max=? ' +
+                     'AND wavelen_min=? AND particle_n=? ' +
+                     'AND particle_max=? AND particle_min=?')
+        self.cursor.execute(selectStr, _indexColumns(n_particle, n_host) +
+                                       [particle_mu,
+                                        particle_sigma,
+                                        effective_model,
+                                        wavelen_n,
+                                        wavelen_max,
+                                        wavelen_min,
+                                        particle_n,
+                                        particle_max,
+                                        particle_min])
+        return(self.cursor.fetchall())
+
+    def __subrangeTable(self,
+                        n_particle,
+                        n_host,
+                        particle_mu,
+                        particle_sigma,
+                        effective_model,
+                        wavelen_n,
+                        wavelen_max,
+                        wavelen_min,
+                        particle_n,
+                        particle_max,
+                        particle_min,
+                        tolerance,
+                        interpolate,
+                        key):
+        '''
+        Private function.
+        Derives the requested table from a cached table whose grids are
+        a superset of the requested grids. Returns the filename of the
+        derived table or None.
+        '''
+        if 'sampling' in key or 'phaseFit' in key:
+            # Alias tables and fits can not be sliced or interpolated
+            return(None)
+        selectStr = ('select filename, wavelen_n, wavelen_max, ' +
+                     'wavelen_min, particle_n, particle_max, particle_min, ' +
+                     'table_key from data where ' +
+                     'n_particle_r = ? AND n_particle_j = ? AND n_host = ? ' +
+                     'AND particle_mu=? ' +
+                     'AND particle_sigma=? ' +
+                     'AND effective_model=?')
+        args = _indexColumns(n_particle, n_host) + [particle_mu,
+                                                    particle_sigma,
+                                                    effective_model]
+        if effective_model:
+            # Effective tables are averaged over the particle grid,
+            # so only the wavelength grid can be sliced.
+            selectStr += (' AND particle_n=? AND particle_max=? ' +
+                          'AND particle_min=?')
+            args.extend([particle_n, particle_max, particle_min])
+        self.cursor.execute(selectStr, args)
+
+        waves = np.linspace(wavelen_min, wavelen_max, wavelen_n)
+        diams = np.linspace(particle_min, particle_max, particle_n)
+
+        for row in self.cursor.fetchall():
+            (c_file, c_wn, c_wmax, c_wmin, c_pn, c_pmax, c_pmin, c_key) = row
+            if not os.path.isfile(c_file):
+                continue
+            if c_key is None and _extendedKey(key):
+                # Rows of older versions have the default resolution
+                continue
+            if c_key is not None and not _sameTable(json.loads(c_key), key,
+                                                    ['wavelengths',
+                                                     'particles']):
+                continue
+            w_align = _alignGrid(np.linspace(c_wmin, c_wmax, c_wn), waves,
+                                 tolerance, interpolate)
+            if w_align is None:
+                continue
+            if effective_model:
+                p_ids = [0]
+            else:
+                p_align = _alignGrid(np.linspace(c_pmin, c_pmax, c_pn),
+                                     diams, tolerance)
+                if p_align is None:
+                    continue
+                p_ids = p_align[0]
+
+            table = mieStorage.loadMieTableBetween(c_file, *w_align,
+                                                   particle_ids=p_ids)
+            t_key = key
+            if np.any(w_align[2] > 0):
+                # Interpolated tables differ from generated ones, so
+                # exact lookups must not find them
+                t_key = dict(key, interpolated=True)
+                self.cursor.execute('select filename from data ' +
+                                    'where key_hash = ?', [keyHash(t_key)])
+                for (i_file,) in self.cursor.fetchall():
+                    if os.path.isfile(i_file):
+                        return(i_file)
+            o_f = self.__tableFile(t_key)
+            print('Deriving mie data from ' + c_file)
+            mieStorage.saveMieTable(o_f,
+                                    wavelengths=waves,
+                                    particle_diameters=table[
+                                        'particleDiameter'],
+                                    cross_sections=table['crossSections'],
+                                    inverse_cdf=table['inverseCDF'],
+                                    rvs=table['rvs'],
+                                    compression=self.compression,
+                                    shuffle=self.shuffle,
+                                    precision=self.precision)
+            self.__addMieFile(o_f, n_particle, n_host, particle_mu,
+                              particle_sigma, effective_model, wavelen_n,
+                              wavelen_max, wavelen_min, particle_n,
+                              particle_max, particle_min, t_key)
+            return(o_f)
+        return(None)
 
     def __generateMie(self,
+                      o_f,
                       n_particle,
                       n_host,
                       particle_mu,
@@ -283,41 +1228,44 @@ class MieDatabase():
                       wavelen_min=100.0,
                       particle_n=20,
                       particle_max=20.0,
-                      particle_min=1.0):
+                      particle_min=1.0,
+                      theta_n=None,
+                      rv_n=None):
         '''
         Private function.
-        Generates new mie-data file for the database.
+        Generates new mie-data file o_f for the database.
         '''
-        n_x_rv = 1000
-        n_tht = 90
+        (n_tht, n_x_rv) = _resolution(effective_model, theta_n, rv_n)[:2]
         wavelengths = np.linspace(wavelen_min, wavelen_max, wavelen_n) / 1000.0
         p_diameters = np.linspace(particle_min, particle_max, particle_n)
+        (n_p, n_h) = self.__opticalConstants(n_particle, n_host,
+                                             wavelengths * 1000.0)
 
-        o_f = ("mie_p-%dum-%dum-%d_" % (particle_min,
-                                        particle_max,
-                                        particle_n) +
-               'np-%s_nh-%.2f_' % (n_particle.__format__('.2f'),
-                                   n_host) +
-               'wave-%.1fnm-%.1fnm-%d' % (wavelen_min,
-                                          wavelen_max,
-                                          wavelen_n) +
-               '.hdf5')
-        o_f = baseDir + '/' + o_f
 
         df = mie.generateMieData(wavelengths,
                                  number_of_rvs=n_x_rv,
                                  number_of_theta_angles=n_tht,
-                                 n_particle=n_particle,
-                                 n_silicone=n_host,
-                                 p_diameters=p_diameters)
+                                 n_particle=n_p,
+                                 n_silicone=n_h,
+                                 p_diameters=p_diameters,
+                                 processes=self.processes,
+                                 regime_tolerance=self.regimeTolerance)
         mie.saveMieDataToHDF5([df],
                               particle_diameters=p_diameters,
                               out_fname=o_f,
-                              wavelengths=wavelengths * 1000.0)
+                              wavelengths=wavelengths * 1000.0,
+                              compression=self.compression,
+                              shuffle=self.shuffle,
+                              precision=self.precision,
+                              alias=self.sampling == 'alias',
+                              rv_tolerance=self.rvTolerance,
+                              phase_fit=self.phaseFit,
+                              processes=self.processes)
 
         return(o_f)
 
     def __generateMieEffective(self,
+                               o_f,
                                n_particle,
                                n_host,
                                particle_mu,
@@ -328,10 +1276,12 @@ class MieDatabase():
                                wavelen_min=100.0,
                                particle_n=20,
                                particle_max=20.0,
-                               particle_min=1.0):
+                               particle_min=1.0,
+                               theta_n=None,
+                               rv_n=None):
         '''
         Private function.
-        Generates new effective mie-data file for the database.
+        Generates new effective mie-data file o_f for the database.
         '''
 
         if particle_n < 10:
@@ -339,21 +1289,12 @@ class MieDatabase():
                 "Too few particles to calculate \
                 effective model: particle_n < 10")
             exit()
-        n_x_rv = 10000
-        n_tht = 91
+        (n_tht, n_x_rv) = _resolution(effective_model, theta_n, rv_n)[:2]
         wavelengths = np.linspace(wavelen_min, wavelen_max, wavelen_n) / 1000.0
         p_diameters = np.linspace(particle_min, particle_max, particle_n)
+        (n_p, n_h) = self.__opticalConstants(n_particle, n_host,
+                                             wavelengths * 1000.0)
 
-        o_f = ("mie_eff_p-%dum-%dum-%d_" % (particle_min,
-                                            particle_max,
-                                            particle_n) +
-               'np-%s_nh-%.2f_' % (n_particle.__format__('.2f'),
-                                   n_host) +
-               'wave-%.1fnm-%.1fnm-%d' % (wavelen_min,
-                                          wavelen_max,
-                                          wavelen_n) +
-               '.hdf5')
-        o_f = baseDir + '/' + o_f
         # Calculate particle distribution
         N = lognorm(particle_sigma, scale=np.exp(particle_mu))
         # Weight factors of each particle size
@@ -362,23 +1303,34 @@ class MieDatabase():
 
         weight = dict(zip(p_diameters, pdf))
 
+        tolerance = self.regimeTolerance
         df = 0
         df = mie.generateMieDataEffective(wavelengths,
                                           p_normed_weights_dict=weight,
                                           number_of_rvs=n_x_rv,
                                           number_of_theta_angles=n_tht,
-                                          n_particle=n_particle,
-                                          n_silicone=n_host,
-                                          p_diameters=p_diameters)
+                                          n_particle=n_p,
+                                          n_silicone=n_h,
+                                          p_diameters=p_diameters,
+                                          processes=self.processes,
+                                          regime_tolerance=tolerance)
         print(df.info())
         mie.saveMieDataToHDF5([df],
                               particle_diameters=[p_diameters.mean()],
                               out_fname=o_f,
-                              wavelengths=wavelengths * 1000.0)
+                              wavelengths=wavelengths * 1000.0,
+                              compression=self.compression,
+                              shuffle=self.shuffle,
+                              precision=self.precision,
+                              alias=self.sampling == 'alias',
+                              rv_tolerance=self.rvTolerance,
+                              phase_fit=self.phaseFit,
+                              processes=self.processes)
 
         return(o_f)
 
     def __generateMieEffectiveArbitrary(self,
+                                        o_f,
                                         n_particle,
                                         n_host,
                                         particle_distribution,
@@ -388,10 +1340,12 @@ class MieDatabase():
                                         wavelen_min=100.0,
                                         particle_n=20,
                                         particle_max=20.0,
-                                        particle_min=1.0):
+                                        particle_min=1.0,
+                                        theta_n=None,
+                                        rv_n=None):
         '''
         Private function.
-        Generates new effective mie-data file for the database.
+        Generates new effective mie-data file o_f for the database.
         '''
 
         if particle_n < 10:
@@ -399,41 +1353,42 @@ class MieDatabase():
                 "Too few particles to calculate \
                 effective model: particle_n < 10")
             exit()
-        n_x_rv = 10000
-        n_tht = 91
+        (n_tht, n_x_rv) = _resolution(effective_model, theta_n, rv_n)[:2]
         wavelengths = np.linspace(wavelen_min, wavelen_max, wavelen_n) / 1000.0
         p_diameters = np.linspace(particle_min, particle_max, particle_n)
+        (n_p, n_h) = self.__opticalConstants(n_particle, n_host,
+                                             wavelengths * 1000.0)
 
-        o_f = ("mie_eff_p-%dum-%dum-%d_" % (particle_min,
-                                            particle_max,
-                                            particle_n) +
-               'np-%s_nh-%.2f_' % (n_particle.__format__('.2f'),
-                                   n_host) +
-               'wave-%.1fnm-%.1fnm-%d' % (wavelen_min,
-                                          wavelen_max,
-                                          wavelen_n) +
-               '.hdf5')
-        o_f = baseDir + '/' + o_f
 
         # Weight factors of each particle size
-        pdf = particle_distribution
-        pdf /= pdf.sum()
+        pdf = np.array(particle_distribution, dtype=float)
+        pdf = pdf / pdf.sum()
 
         weight = dict(zip(p_diameters, pdf))
 
+        tolerance = self.regimeTolerance
         df = 0
         df = mie.generateMieDataEffective(wavelengths,
                                           p_normed_weights_dict=weight,
                                           number_of_rvs=n_x_rv,
                                           number_of_theta_angles=n_tht,
-                                          n_particle=n_particle,
-                                          n_silicone=n_host,
-                                          p_diameters=p_diameters)
+                                          n_particle=n_p,
+                                          n_silicone=n_h,
+                                          p_diameters=p_diameters,
+                                          processes=self.processes,
+                                          regime_tolerance=tolerance)
         print(df.info())
         mie.saveMieDataToHDF5([df],
                               particle_diameters=[p_diameters.mean()],
                               out_fname=o_f,
-                              wavelengths=wavelengths * 1000.0)
+                              wavelengths=wavelengths * 1000.0,
+                              compression=self.compression,
+                              shuffle=self.shuffle,
+                              precision=self.precision,
+                              alias=self.sampling == 'alias',
+                              rv_tolerance=self.rvTolerance,
+                              phase_fit=self.phaseFit,
+                              processes=self.processes)
 
         return(o_f)
 
@@ -14,33 +14,241 @@
 # limitations under the License.
 #
 
+from collections import OrderedDict, deque
 from datetime import datetime
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+import threading
 
 import h5py as h5
 import numpy as np
 import pandas as pd
 
+from . import mieStorage
+from . import mieSampler
+from . import phaseFit
 from . import scatteringTools as st
+from .telemetry import telemetry
 from .bhmie_herbert_kaiser_july2012 import bhmie
 
 
-def calculateMie(data):
-    # Extract data
-    (p, w, n_p, n_medium, th, n_theta, x_rv) = data
-    # Size parameter
+class KernelCache():
+
+    '''
+    In-process cache of Mie kernels (phase function and efficiencies),
+    which depend only on the size parameter x, the relative refractive
+    index m and the number of angles. Tables sharing optical constants
+    and grids reuse each others kernels. Least recently used kernels are
+    dropped after max_entries.
+
+    Keys are rounded to 12 significant digits, so that grids which share
+    points only up to rounding (a strided subset of a linspace, for
+    example) share the kernels. Kernels of dispersive materials are
+    keyed by the index of each wavelength; quantized indices (see
+    refractiveIndex.quantize) let nearby dispersion curves share them.
+    Approximate kernels (see scatteringRegime) are kept apart by their
+    regime.
+    '''
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.kernels = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def key(self, x, m, n_theta, regime='mie'):
+        m = complex(m)
+        return((float('%.12g' % x),
+                complex(float('%.12g' % m.real), float('%.12g' % m.imag)),
+                int(n_theta), regime))
+
+    def get(self, key):
+        with self.lock:
+            kernel = self.kernels.pop(key, None)
+            if kernel is not None:
+                self.kernels[key] = kernel
+        return(kernel)
+
+    def put(self, key, kernel):
+        with self.lock:
+            old = self.kernels.pop(key, None)
+            if old is not None:
+                self.nbytes -= old['phaseFunction'].nbytes
+            self.kernels[key] = kernel
+            self.nbytes += kernel['phaseFunction'].nbytes
+            while len(self.kernels) > self.max_entries:
+                (k, old) = self.kernels.popitem(last=False)
+                self.nbytes -= old['phaseFunction'].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.kernels.clear()
+            self.nbytes = 0
+
+
+kernelCache = KernelCache()
+
+_pool = None
+_poolProcesses = None
+_poolLock = threading.Lock()
+
+
+def getPool(processes=None):
+    '''
+    Returns the worker pool shared by all generators. Defaults to one
+    process per cpu. The pool is recreated if the number of processes
+    changes.
+    '''
+    global _pool, _poolProcesses
+    if processes is None:
+        processes = cpu_count()
+    with _poolLock:
+        if _pool is None or _poolProcesses != processes:
+            if _pool is not None:
+                _pool.close()
+            _pool = Pool(processes=processes)
+            _poolProcesses = processes
+    return(_pool)
+
+
+# Regimes of scatteringRegime and the error models of the
+# approximations, calibrated against bhmie: the Rayleigh limit errs by
+# about RAYLEIGH_ERROR (x |m|)^2, diffraction plus geometric optics by
+# about LARGE_ERROR x^(-2/3) (the larger of the relative extinction
+# error and the max error of the scattering angle distribution).
+REGIMES = ('rayleigh', 'mie', 'large')
+RAYLEIGH_ERROR = 0.25
+LARGE_ERROR = 3.0
+# Min phase shift 2 x |m - 1| of geometric optics
+LARGE_MIN_PHASE_SHIFT = 10.0
+
+
+def scatteringRegime(x, m, tolerance=None):
+    '''
+    Cheapest regime of a sphere with size parameter x and relative
+    refractive index m whose error model stays within tolerance:
+    'rayleigh' for small x |m|, 'large' (diffraction plus geometric
+    optics) for large x and phase shift, otherwise 'mie'. A tolerance of
+    None always gives 'mie'.
+    '''
+    if tolerance is None:
+        return('mie')
+    m = complex(m)
+    if RAYLEIGH_ERROR * (x * abs(m)) ** 2 <= tolerance:
+        return('rayleigh')
+    if (LARGE_ERROR * x ** (-2.0 / 3.0) <= tolerance and
+            2.0 * x * abs(m - 1.0) >= LARGE_MIN_PHASE_SHIFT):
+        return('large')
+    return('mie')
+
+
+def sizeParameter(p, w, n_medium):
     # x      - size parameter = k*radius = 2pi/lambda * radius
     #          (lambda is the wavelength in the medium around the scatterers)
-    x = np.pi * p / (w / n_medium)
+    return(np.pi * p / (w / n_medium))
+
+
+def indicesAtWavelengths(n, wavelengths):
+    '''
+    Refractive index of each wavelength. n is a constant or, for
+    dispersive materials, a sequence of one index per wavelength.
+    '''
+    if np.ndim(n) == 0:
+        return([n] * len(wavelengths))
+    if len(n) != len(wavelengths):
+        raise ValueError('%d refractive indices for %d wavelengths' %
+                         (len(n), len(wavelengths)))
+    return(list(n))
+
+
+def _indexText(n):
+    if np.ndim(n) == 0:
+        if np.iscomplexobj(n):
+            return(complex(n).__format__('.2f'))
+        return('%f' % n)
+    real = np.real(n)
+    return('%.4f - %.4f (dispersive)' % (real.min(), real.max()))
+
+
+def mieKernel(x, m, n_theta, regime='mie'):
+    '''
+    Phase function and efficiencies of a sphere with size parameter x and
+    relative refractive index m. regime selects the full Mie solution
+    or an approximation, see scatteringRegime.
+    '''
+    if regime == 'rayleigh':
+        return(rayleighKernel(x, m, n_theta))
+    if regime == 'large':
+        return(largeParticleKernel(x, m, n_theta))
     # Mie parameters
-    (S1, S2, Qext, Qsca, Qback, gsca) = bhmie(x, n_p / n_medium, n_theta)
+    (S1, S2, Qext, Qsca, Qback, gsca) = bhmie(x, m, n_theta)
     # Phase function
     P = (np.absolute(S1) ** 2.0 + np.absolute(S2) ** 2.0) / \
         (Qsca * x ** 2.0)
-    # Cumulative distribution
-    cP = st.cumulativeDistributionTheta(P, th)
-    # Normalize
-    cP /= cP[-1]
+    return({'phaseFunction': P, 'Qext': Qext, 'Qsca': Qsca, 'gsca': gsca})
+
+
+def rayleighKernel(x, m, n_theta):
+    '''
+    Kernel of mieKernel in the Rayleigh limit x |m| << 1.
+    '''
+    m = complex(m)
+    th = np.linspace(0, np.pi, 2 * n_theta - 1)
+    # Cross section of the unit wavelength over the geometric one
+    d = x / np.pi
+    Qsca = abs(st.rayleighScatteringCrossSection(1.0, m, d)) / \
+        (np.pi * (d / 2.0) ** 2)
+    Qabs = 4.0 * x * ((m ** 2 - 1.0) / (m ** 2 + 2.0)).imag
+    # Normalized as the phase function of bhmie
+    P = 0.5 * st.rayleighScatteringPhaseFunction(np.cos(th))
+    return({'phaseFunction': P, 'Qext': Qsca + Qabs, 'Qsca': Qsca,
+            'gsca': 0.0})
+
+
+def largeParticleKernel(x, m, n_theta):
+    '''
+    Kernel of mieKernel for large spheres, x >> 1: extinction by
+    anomalous diffraction and the phase function of Fraunhofer
+    diffraction plus geometric optics. The kernel also has the
+    cumulative distribution angleCDF of the scattering angle, which
+    resolves diffraction peaks narrower than the angle grid.
+    '''
+    th = np.linspace(0, np.pi, 2 * n_theta - 1)
+    (go, energy) = st.geometricOpticsCDFTheta(th, x, m)
+    # Diffraction scatters the energy incident on the geometric cross
+    # section once more
+    cdf = (st.diffractionCDFTheta(th, x) + energy * go) / (1.0 + energy)
+    density = np.gradient(cdf, th)
+    sin = np.sin(th)
+    P = np.empty(len(th))
+    P[1:-1] = density[1:-1] / sin[1:-1]
+    (P[0], P[-1]) = (P[1], P[-2])
+    P /= np.trapz(P * sin, th)
+    gsca = np.sum(np.diff(cdf) * np.cos(0.5 * (th[1:] + th[:-1])))
+    Qext = st.anomalousDiffractionExtinction(x, m)
+    return({'phaseFunction': P, 'angleCDF': cdf, 'Qext': Qext,
+            'Qsca': Qext * (1.0 + energy) / 2.0, 'gsca': gsca})
+
+
+def calculateMie(data):
+    # Extract data. Optional 8th item is a precalculated kernel (or
+    # None) and 9th the regime of the kernel.
+    (p, w, n_p, n_medium, th, n_theta, x_rv) = data[:7]
+    kernel = data[7] if len(data) > 7 else None
+    regime = data[8] if len(data) > 8 else 'mie'
+    # Size parameter
+    x = sizeParameter(p, w, n_medium)
+    if kernel is None:
+        kernel = mieKernel(x, n_p / n_medium, n_theta, regime)
+    P = kernel['phaseFunction']
+    Qext = kernel['Qext']
+    if 'angleCDF' in kernel:
+        # Exact over the grid cells (large particle approximation)
+        cP = kernel['angleCDF'].copy()
+    else:
+        # Cumulative distribution
+        cP = st.cumulativeDistributionTheta(P, th)
+        # Normalize
+        cP /= cP[-1]
 
     # Inverse cumulative distribution for random variable picking
     cPinv = st.invertNiceFunction(np.degrees(th), cP, x_rv)
@@ -50,20 +258,93 @@ def calculateMie(data):
     pD['sizeParameter'] = x
     pD['wavelength'] = w
     pD['crossSections'] = Qext * np.pi * (p / 2.0) ** 2.0
+    pD['scatteringCrossSection'] = kernel['Qsca'] * np.pi * (p / 2.0) ** 2.0
     pD['inverseCDF'] = cPinv
     pD['phaseFunction'] = P
     pD['cumulativePhaseFunction'] = cP
+    pD['angleDensity'] = mieSampler.angleDensity(P, th)
+    pD['asymmetry'] = kernel['gsca']
+    pD['kernel'] = kernel
 
     # Return generated data
     return pD
 
 
+def _runFair(tasks, processes=None, batch_size=16):
+    '''
+    Runs calculateMie over tasks in the shared pool. Tasks are submitted
+    in batches with only a few batches queued at a time, so that several
+    generators running in parallel threads get fair turns in the pool.
+    Results are returned in the order of tasks.
+    '''
+    pool = getPool(processes)
+    window = 2 * (processes or cpu_count())
+    pending = deque()
+    result = []
+    for i in range(0, len(tasks), batch_size):
+        if len(pending) >= window:
+            result.extend(pending.popleft().get())
+        pending.append(pool.map_async(calculateMie,
+                                      tasks[i:i + batch_size]))
+    while pending:
+        result.extend(pending.popleft().get())
+    return(result)
+
+
+def _calculateTasks(pData, processes=None, regime_tolerance=None):
+    '''
+    Calculates the Mie tasks in the shared pool. Kernels found in
+    kernelCache are attached to the tasks, new kernels are added to it.
+    With regime_tolerance each task is routed to the cheapest regime
+    within the tolerance, see scatteringRegime.
+    Returns the results as a DataFrame.
+    '''
+    keys = []
+    reused = 0
+    regimes = dict((regime, 0) for regime in REGIMES)
+    tasks = []
+    for data in pData:
+        (p, w, n_p, n_medium, th, n_theta, x_rv) = data
+        x = sizeParameter(p, w, n_medium)
+        regime = scatteringRegime(x, n_p / n_medium, regime_tolerance)
+        regimes[regime] += 1
+        key = kernelCache.key(x, n_p / n_medium, n_theta, regime)
+        kernel = kernelCache.get(key)
+        if kernel is not None:
+            reused += 1
+        keys.append(key)
+        tasks.append(data + (kernel, regime))
+    print("Kernels reused: %d / %d" % (reused, len(tasks)))
+    telemetry.count('kernelTasks', len(tasks))
+    telemetry.count('kernelsReused', reused)
+    if regime_tolerance is not None:
+        print("Regimes: %s" % ', '.join(['%s %d' % (regime, regimes[regime])
+                                         for regime in REGIMES]))
+        for regime in REGIMES:
+            telemetry.count('kernels' + regime.capitalize(),
+                            regimes[regime])
+
+    result = _runFair(tasks, processes)
+    for (key, pD) in zip(keys, result):
+        kernelCache.put(key, pD.pop('kernel'))
+    telemetry.gauge('kernelCacheEntries', len(kernelCache.kernels))
+    telemetry.gauge('kernelCacheBytes', kernelCache.nbytes)
+
+    # Make data into DataFrame
+    return(pd.DataFrame(result))
+
+
 def generateMieData(wavelengths, number_of_rvs, number_of_theta_angles,
-                    n_particle, n_silicone, p_diameters):
+                    n_particle, n_silicone, p_diameters, processes=None,
+                    regime_tolerance=None):
     '''
     Mie generator
 
-    Remember to use the same units in wavelengths and p_diameters
+    Remember to use the same units in wavelengths and p_diameters.
+    n_particle and n_silicone are constants or, for dispersive
+    materials, sequences of the index of each wavelength.
+    regime_tolerance enables the Rayleigh and large particle
+    approximations within that accuracy, see scatteringRegime.
     '''
     print("#########################################")
     print("Calculating Mie data...")
@@ -71,8 +352,8 @@ def generateMieData(wavelengths, number_of_rvs, number_of_theta_angles,
           (wavelengths[0], wavelengths[-1], len(wavelengths)))
     print("Particle diams %.1f - %.1f, (%d)" %
           (p_diameters[0], p_diameters[-1], len(p_diameters)))
-    print("n_host %f, n_particle %s" %
-          (n_silicone, n_particle.__format__('.2f')))
+    print("n_host %s, n_particle %s" %
+          (_indexText(n_silicone), _indexText(n_particle)))
     print("Number of RVs: %d" % number_of_rvs)
     print("Number of Theta angles: %d" % number_of_theta_angles)
     startTime = datetime.now()
@@ -83,17 +364,14 @@ def generateMieData(wavelengths, number_of_rvs, number_of_theta_angles,
 
     # Make data for mie calculation queues
     pData = []
+    n_ps = indicesAtWavelengths(n_particle, wavelengths)
+    n_hs = indicesAtWavelengths(n_silicone, wavelengths)
     for p in p_diameters:
-        for wave in wavelengths:
-            pData.extend([(p, wave, n_particle, n_silicone, th, n_tht, x_rv)])
+        for (wave, n_p, n_h) in zip(wavelengths, n_ps, n_hs):
+            pData.extend([(p, wave, n_p, n_h, th, n_tht, x_rv)])
 
-    # Start pool
-    pool = Pool(processes=10)
-    # Start calculating
-    result = pool.map(calculateMie, pData)
-
-    # Make data into DataFrame
-    df = pd.DataFrame(result.get())
+    # Calculate in the shared pool
+    df = _calculateTasks(pData, processes, regime_tolerance)
 
     print()
     print('Calculation took:')
@@ -106,11 +384,17 @@ def generateMieData(wavelengths, number_of_rvs, number_of_theta_angles,
 def generateMieDataEffective(wavelengths, number_of_theta_angles,
                              n_particle, n_silicone, p_diameters,
                              p_normed_weights_dict,
-                             number_of_rvs=1001):
+                             number_of_rvs=1001,
+                             processes=None,
+                             regime_tolerance=None):
     '''
     Mie generator
 
-    Remember to use the same units in wavelengths and p_diameters
+    Remember to use the same units in wavelengths and p_diameters.
+    n_particle and n_silicone are constants or, for dispersive
+    materials, sequences of the index of each wavelength.
+    regime_tolerance enables the Rayleigh and large particle
+    approximations within that accuracy, see scatteringRegime.
     '''
     print("#########################################")
     print("Calculating Mie data...")
@@ -122,19 +406,17 @@ def generateMieDataEffective(wavelengths, number_of_theta_angles,
 
     # Make data for mie calculation queues
     pData = []
+    n_ps = indicesAtWavelengths(n_particle, wavelengths)
+    n_hs = indicesAtWavelengths(n_silicone, wavelengths)
     for p in p_diameters:
-        for wave in wavelengths:
-            pData.extend([(p, wave, n_particle, n_silicone, th, n_tht, x_rv)])
+        for (wave, n_p, n_h) in zip(wavelengths, n_ps, n_hs):
+            pData.extend([(p, wave, n_p, n_h, th, n_tht, x_rv)])
 
-    # Start pool
-    pool = Pool(processes=10)
-    # Start calculating
-    result = pool.map_async(calculateMie, pData)
+    # Calculate in the shared pool
+    df = _calculateTasks(pData, processes, regime_tolerance)
 
     print('Calculating effective data...')
 
-    # Make data into DataFrame
-    df = pd.DataFrame(result.get())
     df['weight'] = df['particleDiameter'].apply(
         lambda x: p_normed_weights_dict[x])
 
@@ -142,11 +424,24 @@ def generateMieDataEffective(wavelengths, number_of_theta_angles,
     df['particleDiameter'] = df['particleDiameter'] * df.weight
     df['crossSections'] = df['crossSections'] * df.weight
     df['inverseCDF'] = df['inverseCDF'] * df.weight
+    # The effective phase function, used for alias tables and phase
+    # function fits, and the asymmetry factor are the mixtures weighted
+    # by number times scattering cross section of each size, normalized
+    # per wavelength. The effective inverse CDF above averages quantiles
+    # by number instead, so it is not the inverse of this mixture.
+    scattered = df.weight * df['scatteringCrossSection']
+    df['scatterWeight'] = scattered / scattered.groupby(
+        df['wavelength']).transform('sum')
+    df['angleDensity'] = df['angleDensity'] * df.scatterWeight
+    df['asymmetry'] = df['asymmetry'] * df.scatterWeight
     g = df.groupby('wavelength')
 
     dd = g.agg({'particleDiameter': 'sum',
                 'crossSections': 'sum',
-                'inverseCDF': lambda x: list(np.sum(list(x.values), axis=0))})
+                'asymmetry': 'sum',
+                'inverseCDF': lambda x: list(np.sum(list(x.values), axis=0)),
+                'angleDensity': lambda x: list(np.sum(list(x.values),
+                                                      axis=0))})
     dd['particleDiameter'] = dd['particleDiameter'].mean()
 
     print()
@@ -160,7 +455,121 @@ def generateMieDataEffective(wavelengths, number_of_theta_angles,
 def saveMieDataToHDF5(df_list,
                       particle_diameters,
                       wavelengths,
-                      out_fname):
+                      out_fname,
+                      format_version=mieStorage.FORMAT_VERSION,
+                      compression=None,
+                      shuffle=False,
+                      precision='float64',
+                      alias=False,
+                      rv_tolerance=None,
+                      phase_fit=None,
+                      processes=None):
+    '''
+    Saves Mie data frames to HDF5.
+
+    format_version 1 writes the legacy layout (one group per particle),
+    newer versions write the chunked layout of mieStorage. compression and
+    shuffle are optional lossless filters for the chunked layout.
+    precision (float64, float32 or uint16) of the inverse CDF is only
+    supported by the chunked layout, see mieStorage.PRECISIONS.
+    With alias, Walker alias tables of the angle densities are stored
+    too (chunked layout only), see mieSampler.AliasSampler.
+    With rv_tolerance (degrees) the inverse CDF is stored only at an
+    adaptive, non-uniform subset of the RVs that reproduces it within
+    the tolerance (chunked layout only).
+    With phase_fit (a model of phaseFit such as hg2 or legendre16) the
+    phase function of each wavelength is fitted in the worker pool and
+    the parameters, fit errors and asymmetry factors are stored too
+    (chunked layout only). Effective tables are fitted to their
+    scattering weighted phase function mixture, see
+    generateMieDataEffective.
+    '''
+    if format_version == 1 and (precision != 'float64' or alias or
+                                rv_tolerance is not None or
+                                phase_fit is not None):
+        raise ValueError('Legacy layout supports only float64 precision '
+                         'on a uniform RV grid without alias tables or '
+                         'phase function fits')
+    if phase_fit is not None:
+        phaseFit.parseModel(phase_fit)
+    if format_version == 1:
+        return(_saveMieDataToHDF5Legacy(df_list, particle_diameters,
+                                        wavelengths, out_fname))
+
+    print("Saving Mie-data...")
+    cross = []
+    inv = []
+    dens = []
+    asym = []
+    for df in df_list:
+        groups = df.groupby('particleDiameter')
+        for name, g in groups:
+            g = g.sort_values('wavelength')
+            cross.append(g['crossSections'].values)
+            inv.append(np.vstack(g['inverseCDF'].values))
+            if alias or phase_fit is not None:
+                dens.append(np.vstack(g['angleDensity'].values))
+                asym.append(g['asymmetry'].values)
+
+    inv = np.array(inv)
+    rvs = np.linspace(0, 1, inv.shape[-1])
+    if rv_tolerance is not None:
+        nodes = mieStorage.adaptiveRVNodes(inv, rvs, rv_tolerance)
+        print("Adaptive RV grid: %d / %d nodes" % (len(nodes), len(rvs)))
+        inv = np.ascontiguousarray(inv[:, :, nodes])
+        rvs = rvs[nodes]
+
+    tables = None
+    fit = None
+    if dens:
+        # Angle grid of the generator
+        theta = np.linspace(0, np.pi, dens[0].shape[-1])
+    if alias:
+        tables = mieSampler.aliasTables(theta, np.array(dens))
+    if phase_fit is not None:
+        fit = _fitPhaseFunctions(theta, np.array(dens), phase_fit,
+                                 processes)
+        fit['asymmetry'] = np.array(asym)
+
+    mieStorage.saveMieTable(out_fname,
+                            wavelengths=wavelengths,
+                            particle_diameters=particle_diameters,
+                            cross_sections=np.array(cross),
+                            inverse_cdf=inv,
+                            rvs=rvs,
+                            compression=compression,
+                            shuffle=shuffle,
+                            precision=precision,
+                            alias=tables,
+                            phase_fit=fit)
+    print("Saved!")
+
+
+def _fitPhaseFunctions(theta, densities, spec, processes=None):
+    '''
+    Fits the phase function model spec to the angle densities
+    (particle, wavelength, angle) in the shared pool.
+    '''
+    startTime = datetime.now()
+    rows = densities.reshape(-1, densities.shape[-1])
+    tasks = [(theta, d, spec) for d in rows]
+    result = getPool(processes).map(phaseFit.fitPhaseFunctionTask, tasks,
+                                    chunksize=16)
+    shape = densities.shape[:-1]
+    parameters = np.array([r[0] for r in result])
+    error = np.array([r[1] for r in result])
+    print("Phase function fit %s: max error %.4f, took %s" %
+          (spec, error.max(),
+           str(datetime.now() - startTime).split('.', 2)[0]))
+    return({'model': spec,
+            'parameters': parameters.reshape(shape + (-1,)),
+            'error': error.reshape(shape)})
+
+
+def _saveMieDataToHDF5Legacy(df_list,
+                             particle_diameters,
+                             wavelengths,
+                             out_fname):
     print("Saving Mie-data...")
 
     # print(df.info())
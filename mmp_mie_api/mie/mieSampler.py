@@ -0,0 +1,362 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numpy as np
+
+from . import mieStorage
+from . import phaseFit
+from . import scatteringTools as st
+
+
+def uniformRVs(count, seed=None):
+    '''
+    count uniform random numbers in [0, 1) from a generator seeded with
+    seed (None seeds from the operating system).
+    '''
+    return(np.random.RandomState(seed).random_sample(int(count)))
+
+
+class InverseCDFSampler():
+
+    '''
+    Samples scattering angles (degrees) from an inverse CDF table.
+
+    inverse_cdf has shape (wavelength, RV); a transposed view of the
+    property orientation (RV, wavelength) is fine. Samples are bilinearly
+    interpolated in wavelength and RV, so arbitrary wavelengths inside the
+    table range and continuous random numbers can be used.
+
+    Non-uniform RV grids (adaptive tables) are located with a guide
+    table, which takes on average one step per sample.
+    '''
+
+    def __init__(self, wavelengths, inverse_cdf, rvs=None):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.inverseCDF = inverse_cdf
+        if rvs is None:
+            rvs = np.linspace(0, 1, inverse_cdf.shape[1])
+        self.rvs = np.asarray(rvs, dtype=float)
+        self.guide = None
+        if not mieStorage.isUniformGrid(self.rvs):
+            # Last node at or below j / len(guide)
+            n = len(self.rvs)
+            self.guide = np.clip(np.searchsorted(
+                self.rvs, np.arange(n) / float(n), side='right') - 1,
+                0, n - 2)
+
+    def _rvBrackets(self, u):
+        n = len(self.rvs)
+        if n < 2:
+            zero = np.zeros(len(u), dtype=int)
+            return(zero, zero, np.zeros(len(u)))
+        if self.guide is None:
+            lower = np.clip((u * (n - 1)).astype(int), 0, n - 2)
+        else:
+            lower = self.guide[np.clip((u * n).astype(int), 0, n - 1)]
+            step = (lower < n - 2) & (self.rvs[lower + 1] <= u)
+            while np.any(step):
+                lower = lower + step
+                step = (lower < n - 2) & (self.rvs[lower + 1] <= u)
+        upper = lower + 1
+        fraction = np.clip((u - self.rvs[lower]) /
+                           (self.rvs[upper] - self.rvs[lower]), 0.0, 1.0)
+        return(lower, upper, fraction)
+
+    @classmethod
+    def fromTable(cls, table, particle_id=0):
+        '''
+        Sampler of one particle of a table loaded with
+        mieStorage.loadMieTable.
+        '''
+        return(cls(table['wavelengths'], table['inverseCDF'][particle_id],
+                   table['rvs']))
+
+    @classmethod
+    def fromFile(cls, fname, particle_id=0):
+        return(cls.fromTable(mieStorage.loadMieTable(
+            fname, particle_ids=[particle_id])))
+
+    def sample(self, wavelengths, u):
+        '''
+        Scattering angles for wavelengths (nm) and uniform random numbers
+        u in [0, 1]. A scalar wavelength is used for all numbers.
+
+        :return: Angles in degrees, one per random number
+        :rtype: numpy.ndarray
+        '''
+        u = np.atleast_1d(np.asarray(u, dtype=float))
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if wavelengths.ndim == 0:
+            wavelengths = np.repeat(wavelengths, len(u))
+        if len(wavelengths) != len(u):
+            raise ValueError('Got %d wavelengths for %d random numbers' %
+                             (len(wavelengths), len(u)))
+        if len(u) == 0:
+            return(np.zeros(0))
+        if (wavelengths.min() < self.wavelengths[0] - 1e-9 or
+                wavelengths.max() > self.wavelengths[-1] + 1e-9):
+            raise ValueError('Wavelengths outside of table range '
+                             '%.1f - %.1f' % (self.wavelengths[0],
+                                              self.wavelengths[-1]))
+
+        (wl, wu, wf) = mieStorage.wavelengthBrackets(self.wavelengths,
+                                                     wavelengths)
+        (rl, ru, rf) = self._rvBrackets(np.clip(u, 0.0, 1.0))
+        icdf = self.inverseCDF
+        lower = (1.0 - rf) * icdf[wl, rl] + rf * icdf[wl, ru]
+        upper = (1.0 - rf) * icdf[wu, rl] + rf * icdf[wu, ru]
+        return((1.0 - wf) * lower + wf * upper)
+
+    def sampleN(self, wavelengths, count, seed=None):
+        '''
+        count scattering angles with random numbers drawn from seed.
+        '''
+        return(self.sample(wavelengths, uniformRVs(count, seed)))
+
+
+def angleDensity(phase_function, theta):
+    '''
+    Probability density over scattering angle theta (radians) of a phase
+    function, P(theta) sin(theta) normalized to unit integral.
+    '''
+    f = np.asarray(phase_function, dtype=float) * np.sin(theta)
+    return(f / np.trapz(f, theta))
+
+
+def buildAliasTable(probabilities):
+    '''
+    Walker alias table (Vose's method) of discrete probabilities.
+
+    :return: (probability, alias). Bin i is chosen with probability[i],
+             otherwise alias[i].
+    '''
+    p = np.asarray(probabilities, dtype=float)
+    n = len(p)
+    scaled = list(p * (n / p.sum()))
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = (scaled[l] + scaled[s]) - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # Left overs are 1 up to rounding
+    return(prob, alias)
+
+
+def aliasTables(theta, densities):
+    '''
+    Alias tables of angle densities (see angleDensity) with shape
+    (..., angle) on the angle grid theta (radians). The density is
+    piecewise linear, so bin probabilities are the trapezoidal masses.
+
+    :return: dict of angles (degrees), density, probability and alias
+    :rtype: dict
+    '''
+    densities = np.asarray(densities, dtype=float)
+    shape = densities.shape[:-1]
+    flat = densities.reshape(-1, densities.shape[-1])
+    mass = 0.5 * (flat[:, 1:] + flat[:, :-1]) * np.diff(theta)
+    n_bins = mass.shape[-1]
+    prob = np.empty(mass.shape)
+    alias = np.empty(mass.shape,
+                     dtype=np.uint16 if n_bins <= 65535 else np.int32)
+    for i in range(len(mass)):
+        (prob[i], alias[i]) = buildAliasTable(mass[i])
+    return({'angles': np.degrees(theta),
+            'density': densities.astype(np.float32),
+            'probability': prob.reshape(shape + (n_bins,))
+            .astype(np.float32),
+            'alias': alias.reshape(shape + (n_bins,))})
+
+
+class AliasSampler():
+
+    '''
+    Samples scattering angles (degrees) in O(1) from Walker alias tables
+    over angle bins, one table per wavelength. The position inside a bin
+    follows the linear density between the bin edges, so the sampled
+    distribution is exactly the piecewise linear angle density, which
+    takes far less storage than a dense inverse CDF of equal accuracy.
+
+    Between table wavelengths the lower or the upper table is chosen at
+    random with the interpolation weights, which samples the linearly
+    interpolated density.
+    '''
+
+    def __init__(self, wavelengths, angles, density, probability, alias):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.angles = np.asarray(angles, dtype=float)
+        self.density = density
+        self.probability = probability
+        self.alias = alias
+
+    @classmethod
+    def fromTable(cls, table, particle_id=0):
+        '''
+        Sampler of one particle of a table loaded with
+        mieStorage.loadMieTable from a file with alias tables.
+        '''
+        if 'alias' not in table:
+            raise ValueError('Table has no alias tables')
+        a = table['alias']
+        return(cls(table['wavelengths'], a['angles'],
+                   a['density'][particle_id], a['probability'][particle_id],
+                   a['alias'][particle_id]))
+
+    def sample(self, wavelengths, u):
+        '''
+        Scattering angles for wavelengths (nm) and uniform random numbers
+        u in [0, 1). Each number is reused for the bin, alias, wavelength
+        and in-bin choices, one number per sample is enough.
+
+        :return: Angles in degrees, one per random number
+        :rtype: numpy.ndarray
+        '''
+        u = np.atleast_1d(np.asarray(u, dtype=float))
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if wavelengths.ndim == 0:
+            wavelengths = np.repeat(wavelengths, len(u))
+        if len(wavelengths) != len(u):
+            raise ValueError('Got %d wavelengths for %d random numbers' %
+                             (len(wavelengths), len(u)))
+        if len(u) == 0:
+            return(np.zeros(0))
+        if (wavelengths.min() < self.wavelengths[0] - 1e-9 or
+                wavelengths.max() > self.wavelengths[-1] + 1e-9):
+            raise ValueError('Wavelengths outside of table range '
+                             '%.1f - %.1f' % (self.wavelengths[0],
+                                              self.wavelengths[-1]))
+
+        n_bins = self.probability.shape[-1]
+        (wl, wu, wf) = mieStorage.wavelengthBrackets(self.wavelengths,
+                                                     wavelengths)
+        # Wavelength table
+        upper = u < wf
+        r = np.where(upper, u / np.where(upper, wf, 1.0),
+                     (u - wf) / np.where(upper, 1.0, 1.0 - wf))
+        w = np.where(upper, wu, wl)
+        # Bin and alias
+        r = np.clip(r, 0.0, 1.0 - 1e-12) * n_bins
+        i = r.astype(int)
+        r -= i
+        prob = self.probability[w, i]
+        keep = r < prob
+        k = np.where(keep, i, self.alias[w, i])
+        r = np.where(keep, r / np.where(keep, prob, 1.0),
+                     (r - prob) / np.where(keep, 1.0, 1.0 - prob))
+        r = np.clip(r, 0.0, 1.0)
+        # Linear density inside the bin
+        a = self.density[w, k].astype(float)
+        b = self.density[w, k + 1].astype(float)
+        d = b - a
+        linear = np.abs(d) > 1e-9 * np.maximum(a + b, 1e-300)
+        t = np.where(linear,
+                     (np.sqrt(np.maximum(a * a + (b * b - a * a) * r, 0.0)) -
+                      a) / np.where(linear, d, 1.0),
+                     r)
+        return(self.angles[k] + t * (self.angles[k + 1] - self.angles[k]))
+
+    def sampleN(self, wavelengths, count, seed=None):
+        '''
+        count scattering angles with random numbers drawn from seed.
+        '''
+        return(self.sample(wavelengths, uniformRVs(count, seed)))
+
+
+class HenyeyGreensteinSampler():
+
+    '''
+    Samples scattering angles (degrees) analytically from a fit of
+    Henyey-Greenstein lobes (phaseFit model hgN), one set of lobes per
+    wavelength. Between table wavelengths the lower or the upper set is
+    chosen at random with the interpolation weights, like AliasSampler.
+    The accuracy is that of the fit, see the stored fit error.
+    '''
+
+    def __init__(self, wavelengths, parameters):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        p = np.asarray(parameters, dtype=float)
+        p = p.reshape(p.shape[0], -1, 2)
+        self.cumulativeWeights = np.cumsum(p[:, :, 0], axis=1)
+        self.cumulativeWeights /= self.cumulativeWeights[:, -1:]
+        self.asymmetry = p[:, :, 1]
+
+    @classmethod
+    def fromTable(cls, table, particle_id=0):
+        '''
+        Sampler of one particle of a table loaded with
+        mieStorage.loadMieTable from a file with a Henyey-Greenstein fit.
+        '''
+        fit = table.get('phaseFit')
+        if fit is None or phaseFit.parseModel(fit['model'])[0] != 'hg':
+            raise ValueError('Table has no Henyey-Greenstein fit')
+        return(cls(table['wavelengths'], fit['parameters'][particle_id]))
+
+    def sample(self, wavelengths, u):
+        '''
+        Scattering angles for wavelengths (nm) and uniform random numbers
+        u in [0, 1). Each number is reused for the wavelength, lobe and
+        angle choices.
+
+        :return: Angles in degrees, one per random number
+        :rtype: numpy.ndarray
+        '''
+        u = np.atleast_1d(np.asarray(u, dtype=float))
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if wavelengths.ndim == 0:
+            wavelengths = np.repeat(wavelengths, len(u))
+        if len(wavelengths) != len(u):
+            raise ValueError('Got %d wavelengths for %d random numbers' %
+                             (len(wavelengths), len(u)))
+        if len(u) == 0:
+            return(np.zeros(0))
+        if (wavelengths.min() < self.wavelengths[0] - 1e-9 or
+                wavelengths.max() > self.wavelengths[-1] + 1e-9):
+            raise ValueError('Wavelengths outside of table range '
+                             '%.1f - %.1f' % (self.wavelengths[0],
+                                              self.wavelengths[-1]))
+
+        (wl, wu, wf) = mieStorage.wavelengthBrackets(self.wavelengths,
+                                                     wavelengths)
+        # Wavelength
+        upper = u < wf
+        r = np.where(upper, u / np.where(upper, wf, 1.0),
+                     (u - wf) / np.where(upper, 1.0, 1.0 - wf))
+        w = np.where(upper, wu, wl)
+        r = np.clip(r, 0.0, 1.0)
+        # Lobe
+        cw = self.cumulativeWeights[w]
+        k = np.minimum((cw <= r[:, np.newaxis]).sum(axis=1),
+                       cw.shape[1] - 1)
+        low = np.where(k > 0, cw[np.arange(len(k)), k - 1], 0.0)
+        width = cw[np.arange(len(k)), k] - low
+        r = np.clip((r - low) / np.where(width > 0, width, 1.0), 0.0, 1.0)
+        g = self.asymmetry[w, k]
+        return(np.degrees(st.henyeyGreensteinInverseCDFTheta(r, g)))
+
+    def sampleN(self, wavelengths, count, seed=None):
+        '''
+        count scattering angles with random numbers drawn from seed.
+        '''
+        return(self.sample(wavelengths, uniformRVs(count, seed)))
@@ -0,0 +1,549 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import threading
+
+import h5py as h5
+import numpy as np
+
+from .telemetry import telemetry
+
+# Version 1 is the legacy layout: one group per particle in particleData
+# with inverseCDF of shape (RVs, wavelengths).
+# Version 2 stores a single dataset per quantity with shape
+# (particle, wavelength, RV), chunked along the wavelength axis.
+FORMAT_VERSION = 2
+LAYOUT = 'particle-wavelength-rv'
+
+# Precisions of the stored inverse CDF (scattering angles in degrees).
+# uint16 is fixed point over 0 - 180 degrees, its max error is half a
+# step plus the rounding of the float32 decoded values,
+# UINT16_MAX_ERROR = 0.0014 degrees. float32 has a max relative error of
+# 6e-8 (0.00001 degrees at 180).
+PRECISIONS = ('float64', 'float32', 'uint16')
+ANGLE_MAX = 180.0
+UINT16_STEP = ANGLE_MAX / 65535
+UINT16_MAX_ERROR = UINT16_STEP / 2 + ANGLE_MAX * 2.0 ** -24
+
+
+def encodeAngles(a, precision='float64'):
+    '''
+    Angles (degrees) in the storage representation of precision.
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision %s, use one of %s' %
+                         (str(precision), ', '.join(PRECISIONS)))
+    if precision == 'uint16':
+        codes = np.rint(np.clip(a, 0.0, ANGLE_MAX) / UINT16_STEP)
+        return(codes.astype(np.uint16))
+    return(np.asarray(a, dtype=precision))
+
+
+def decodeAngles(a, precision='float64'):
+    '''
+    Angles (degrees) of the storage representation of precision. Compact
+    precisions decode to float32.
+    '''
+    if precision == 'uint16':
+        return(a.astype(np.float32) * np.float32(UINT16_STEP))
+    return(a)
+
+
+def saveMieTable(out_fname,
+                 wavelengths,
+                 particle_diameters,
+                 cross_sections,
+                 inverse_cdf,
+                 rvs=None,
+                 compression=None,
+                 compression_opts=None,
+                 shuffle=False,
+                 wavelength_chunk=1,
+                 precision='float64',
+                 alias=None,
+                 phase_fit=None):
+    '''
+    Saves a Mie table in the versioned (FORMAT_VERSION) layout.
+
+    cross_sections has shape (particle, wavelength) and inverse_cdf
+    (particle, wavelength, RV). inverse_cdf is chunked along wavelength
+    (wavelength_chunk columns per chunk) so that reading a few wavelengths
+    only touches those chunks. compression ('gzip' or 'lzf') and shuffle
+    are the lossless HDF5 filters. precision (float64, float32 or
+    uint16) is the representation of the inverse CDF, see PRECISIONS.
+    alias is an optional dict of alias tables (mieSampler.aliasTables)
+    with density (particle, wavelength, angle), probability and alias
+    (particle, wavelength, bin) stored next to the inverse CDF.
+    phase_fit is an optional dict of a parametric phase function fit
+    (see phaseFit): model (e.g. hg2), parameters (particle, wavelength,
+    parameter), error and asymmetry (particle, wavelength).
+    '''
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    particle_diameters = np.atleast_1d(np.asarray(particle_diameters,
+                                                  dtype=float))
+    cross_sections = np.asarray(cross_sections)
+    inverse_cdf = encodeAngles(inverse_cdf, precision)
+    (n_p, n_w, n_rv) = inverse_cdf.shape
+    if rvs is None:
+        rvs = np.linspace(0, 1, n_rv)
+
+    filters = {}
+    if compression is not None:
+        filters['compression'] = compression
+        if compression_opts is not None:
+            filters['compression_opts'] = compression_opts
+    if shuffle:
+        filters['shuffle'] = True
+
+    # Written to a temporary file and renamed, so that other processes
+    # sharing the directory never see partially written tables.
+    tmp_fname = _tempName(out_fname)
+    f = h5.File(tmp_fname, 'w')
+    f.attrs['formatVersion'] = FORMAT_VERSION
+    f.attrs['layout'] = LAYOUT
+    f.attrs['wavelengthMin'] = wavelengths[0]
+    f.attrs['wavelengthMax'] = wavelengths[-1]
+    f.attrs['wavelengthN'] = n_w
+    f.attrs['particleN'] = n_p
+    f.attrs['rvN'] = n_rv
+
+    f.create_dataset('wavelengths', data=wavelengths)
+    f.create_dataset('particleDiameter', data=particle_diameters)
+    f.create_dataset('particleID', data=np.arange(n_p))
+    f.create_dataset('rvs', data=rvs)
+
+    w_chunk = max(1, min(int(wavelength_chunk), n_w))
+    f.create_dataset('crossSections',
+                     data=cross_sections,
+                     chunks=(1, n_w),
+                     **filters)
+    dset = f.create_dataset('inverseCDF',
+                            data=inverse_cdf,
+                            chunks=(1, w_chunk, n_rv),
+                            **filters)
+    dset.attrs['precision'] = precision
+    if alias is not None:
+        f.create_dataset('aliasAngles', data=alias['angles'])
+        for (name, key) in [('aliasDensity', 'density'),
+                            ('aliasProbability', 'probability'),
+                            ('aliasIndex', 'alias')]:
+            data = np.asarray(alias[key])
+            f.create_dataset(name, data=data,
+                             chunks=(1, w_chunk, data.shape[-1]),
+                             **filters)
+    if phase_fit is not None:
+        dset = f.create_dataset('phaseFitParameters',
+                                data=np.asarray(phase_fit['parameters']))
+        dset.attrs['model'] = phase_fit['model']
+        f.create_dataset('phaseFitError',
+                         data=np.asarray(phase_fit['error']))
+        f.create_dataset('asymmetry',
+                         data=np.asarray(phase_fit['asymmetry']))
+    f.close()
+    _replaceFile(tmp_fname, out_fname)
+
+
+def _tempName(fname):
+    '''
+    Temporary name of fname unique to the process and thread, so that
+    threads writing the same table never share the temporary file.
+    '''
+    return('%s.tmp%d.%d' % (fname, os.getpid(),
+                            threading.current_thread().ident))
+
+
+def _replaceFile(src, dst):
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows does not replace existing files
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def formatVersion(fname):
+    '''
+    Returns the storage format version of a Mie table file.
+    '''
+    f = h5.File(fname, 'r')
+    version = int(f.attrs.get('formatVersion', 1))
+    f.close()
+    return(version)
+
+
+def loadMieTable(fname, particle_ids=None, wavelength_index=None):
+    '''
+    Loads a Mie table written in either the legacy or the versioned layout.
+
+    particle_ids selects particles (default all) and wavelength_index is a
+    slice or an increasing array of wavelength indices (default all). Only
+    the requested part of the file is read.
+
+    Returns a dict with wavelengths, particleDiameter, rvs, precision,
+    crossSections (particle, wavelength) and
+    inverseCDF (particle, wavelength, RV). The inverse CDF of compact
+    tables is decoded to float32. Tables with alias tables also have
+    alias, a dict of angles, density, probability and alias, and tables
+    with a phase function fit phaseFit, a dict of model, parameters,
+    error and asymmetry.
+    '''
+    if wavelength_index is None:
+        wavelength_index = slice(None)
+    elif not isinstance(wavelength_index, slice):
+        wavelength_index = list(np.asarray(wavelength_index, dtype=int))
+
+    with telemetry.timer('tableRead'):
+        table = _loadMieTable(fname, particle_ids, wavelength_index)
+    telemetry.count('tablesRead')
+    telemetry.count('bytesRead', table['crossSections'].nbytes +
+                    table['inverseCDF'].nbytes)
+    return(table)
+
+
+def _loadMieTable(fname, particle_ids, wavelength_index):
+    f = h5.File(fname, 'r')
+    version = int(f.attrs.get('formatVersion', 1))
+    diameters = np.atleast_1d(f['particleDiameter'][:])
+    if particle_ids is None:
+        particle_ids = list(f['particleID'][:])
+    particle_ids = [int(i) for i in np.atleast_1d(particle_ids)]
+
+    table = {'formatVersion': version,
+             'wavelengths': f['wavelengths'][wavelength_index]}
+
+    if version == 1:
+        cross = []
+        inv = []
+        for i in particle_ids:
+            grp = f['particleData'][str(i)]
+            cross.append(grp['crossSections'][wavelength_index])
+            inv.append(grp['inverseCDF'][:, wavelength_index].T)
+        table['crossSections'] = np.array(cross)
+        table['inverseCDF'] = np.array(inv)
+        table['rvs'] = np.linspace(0, 1, table['inverseCDF'].shape[-1])
+        table['precision'] = 'float64'
+    else:
+        cross = []
+        inv = []
+        for i in particle_ids:
+            cross.append(f['crossSections'][i, wavelength_index])
+            inv.append(f['inverseCDF'][i, wavelength_index, :])
+        precision = f['inverseCDF'].attrs.get('precision', 'float64')
+        if not isinstance(precision, str):
+            precision = precision.decode('ascii')
+        table['precision'] = precision
+        table['crossSections'] = np.array(cross)
+        table['inverseCDF'] = decodeAngles(np.array(inv), precision)
+        table['rvs'] = f['rvs'][:]
+        if 'aliasProbability' in f:
+            table['alias'] = {'angles': f['aliasAngles'][:]}
+            for (name, key) in [('aliasDensity', 'density'),
+                                ('aliasProbability', 'probability'),
+                                ('aliasIndex', 'alias')]:
+                table['alias'][key] = np.array(
+                    [f[name][i, wavelength_index, :] for i in particle_ids])
+        if 'phaseFitParameters' in f:
+            model = f['phaseFitParameters'].attrs['model']
+            if not isinstance(model, str):
+                model = model.decode('ascii')
+            table['phaseFit'] = {'model': model}
+            for (name, key) in [('phaseFitParameters', 'parameters'),
+                                ('phaseFitError', 'error'),
+                                ('asymmetry', 'asymmetry')]:
+                table['phaseFit'][key] = np.array(
+                    [f[name][i, wavelength_index] for i in particle_ids])
+
+    if len(diameters) == 1:
+        table['particleDiameter'] = diameters
+    else:
+        table['particleDiameter'] = diameters[particle_ids]
+    f.close()
+    return(table)
+
+
+def wavelengthBrackets(grid, wavelengths):
+    '''
+    Returns (lower, upper, fraction) index arrays for linear interpolation
+    of the given wavelengths on an increasing wavelength grid.
+    '''
+    grid = np.asarray(grid, dtype=float)
+    wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=float))
+    if len(grid) < 2:
+        n = len(wavelengths)
+        return(np.zeros(n, dtype=int), np.zeros(n, dtype=int), np.zeros(n))
+    lower = np.clip(np.searchsorted(grid, wavelengths, side='right') - 1,
+                    0, len(grid) - 2)
+    upper = lower + 1
+    fraction = np.clip((wavelengths - grid[lower]) /
+                       (grid[upper] - grid[lower]), 0.0, 1.0)
+    return(lower, upper, fraction)
+
+
+def loadMieTableBetween(fname, lower, upper, fraction, particle_ids=None):
+    '''
+    Loads a table linearly interpolated between wavelength columns
+    lower and upper with weights (1 - fraction, fraction). Only the
+    needed columns are read.
+    '''
+    lower = np.asarray(lower, dtype=int)
+    upper = np.asarray(upper, dtype=int)
+    fraction = np.asarray(fraction, dtype=float)
+    needed = np.unique(np.concatenate([lower, upper]))
+    table = loadMieTable(fname, particle_ids=particle_ids,
+                         wavelength_index=needed)
+    # Alias tables and phase function fits are not interpolated
+    table.pop('alias', None)
+    table.pop('phaseFit', None)
+    lo = np.searchsorted(needed, lower)
+    up = np.searchsorted(needed, upper)
+    w = fraction[:, np.newaxis]
+    table['wavelengths'] = ((1.0 - fraction) * table['wavelengths'][lo] +
+                            fraction * table['wavelengths'][up])
+    table['crossSections'] = ((1.0 - fraction) *
+                              table['crossSections'][:, lo] +
+                              fraction * table['crossSections'][:, up])
+    table['inverseCDF'] = ((1.0 - w) * table['inverseCDF'][:, lo] +
+                           w * table['inverseCDF'][:, up])
+    return(table)
+
+
+def interpolateMieTable(fname, wavelengths, particle_ids=None):
+    '''
+    Cross sections and inverse CDF rows at arbitrary wavelengths, linearly
+    interpolated from the table in fname. Wavelengths must lie inside the
+    wavelength range of the table.
+    '''
+    wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=float))
+    f = h5.File(fname, 'r')
+    grid = f['wavelengths'][:]
+    f.close()
+    if (wavelengths.min() < grid[0] - 1e-9 or
+            wavelengths.max() > grid[-1] + 1e-9):
+        raise ValueError('Wavelengths outside of table range %.1f - %.1f' %
+                         (grid[0], grid[-1]))
+    (lower, upper, fraction) = wavelengthBrackets(grid, wavelengths)
+    table = loadMieTableBetween(fname, lower, upper, fraction, particle_ids)
+    table['wavelengths'] = wavelengths
+    return(table)
+
+
+def resampleRVs(table, rvs):
+    '''
+    Returns the table with the inverse CDF linearly interpolated onto
+    another RV grid.
+    '''
+    rvs = np.asarray(rvs, dtype=float)
+    (lower, upper, fraction) = wavelengthBrackets(table['rvs'], rvs)
+    icdf = table['inverseCDF']
+    table = dict(table)
+    table['inverseCDF'] = ((1.0 - fraction) * icdf[:, :, lower] +
+                           fraction * icdf[:, :, upper])
+    table['rvs'] = rvs
+    return(table)
+
+
+def isUniformGrid(grid, tolerance=1e-9):
+    '''
+    True if grid is evenly spaced.
+    '''
+    grid = np.asarray(grid, dtype=float)
+    if len(grid) < 3:
+        return(True)
+    step = np.diff(grid)
+    return(np.all(np.abs(step - step.mean()) <= tolerance))
+
+
+def adaptiveRVNodes(inverse_cdf, rvs, tolerance):
+    '''
+    Indices of a subset of the RV grid rvs such that linear interpolation
+    between the selected nodes reproduces every row of inverse_cdf
+    (..., RV) within tolerance degrees. Intervals are split at their
+    point of largest error, so nodes gather where the inverse CDF is
+    curved, e.g. in the forward scattering lobe.
+    '''
+    rvs = np.asarray(rvs, dtype=float)
+    rows = np.asarray(inverse_cdf, dtype=float).reshape(-1, len(rvs))
+    nodes = set([0, len(rvs) - 1])
+    stack = [(0, len(rvs) - 1)]
+    while stack:
+        (i, j) = stack.pop()
+        if j - i < 2:
+            continue
+        t = (rvs[i + 1:j] - rvs[i]) / (rvs[j] - rvs[i])
+        line = rows[:, i:i + 1] + t * (rows[:, j:j + 1] - rows[:, i:i + 1])
+        error = np.abs(rows[:, i + 1:j] - line).max(axis=0)
+        k = int(np.argmax(error))
+        if error[k] > tolerance:
+            k += i + 1
+            nodes.add(k)
+            stack.append((i, k))
+            stack.append((k, j))
+    return(np.array(sorted(nodes)))
+
+
+def mixInverseCDFs(inverse_cdfs, weights, rvs, max_rows=20):
+    '''
+    Inverse CDF of a mixture of distributions given by their inverse
+    CDFs (rows of inverse_cdfs on the RV grid rvs) and non-negative
+    weights. The component CDFs are evaluated on the union of their
+    angles, mixed and inverted again, which is exact for piecewise
+    linear inverse CDFs (averaging the quantiles is not). With more
+    than max_rows rows the union is taken over max_rows of them.
+    '''
+    rows = np.asarray(inverse_cdfs, dtype=float).reshape(-1, len(rvs))
+    weights = np.asarray(weights, dtype=float).ravel()
+    keep = weights > 0
+    (rows, weights) = (rows[keep], weights[keep] / weights[keep].sum())
+    if len(rows) == 1:
+        return(rows[0].copy())
+    nodes = rows
+    if len(rows) > max_rows:
+        nodes = rows[np.linspace(0, len(rows) - 1, max_rows).astype(int)]
+    angles = np.unique(np.concatenate([nodes.ravel(), rows[:, 0],
+                                       rows[:, -1]]))
+    cdf = np.zeros(len(angles))
+    for (row, w) in zip(rows, weights):
+        cdf += w * np.interp(angles, row, rvs)
+    return(np.interp(rvs, cdf, angles))
+
+
+def bandAverageTable(table, spectrum_wavelengths, spectrum, n_bins):
+    '''
+    Table averaged over spectral bands of equal power of an emission
+    spectrum (e.g. of an LED), given at spectrum_wavelengths (nm) and
+    interpolated onto the table wavelengths (zero outside).
+
+    Cross sections are power weighted means, so the spectrum weighted
+    cross section is preserved. The inverse CDF of a band is that of
+    the mixture of the phase functions weighted by power times cross
+    section (see mixInverseCDFs). Bands are at most n_bins, a single
+    wavelength carrying more power than a band is a band of its own.
+    The band wavelength is the power weighted centroid.
+
+    :return: The band table, with bands (band, 4): centroid, lower and
+             upper wavelength and power fraction of each band
+    :rtype: dict
+    '''
+    w = np.asarray(table['wavelengths'], dtype=float)
+    s = np.interp(w, np.asarray(spectrum_wavelengths, dtype=float),
+                  np.asarray(spectrum, dtype=float), left=0.0, right=0.0)
+    # Trapezoidal quadrature weights over the table wavelengths
+    if len(w) > 1:
+        dw = np.zeros(len(w))
+        dw[1:] += 0.5 * np.diff(w)
+        dw[:-1] += 0.5 * np.diff(w)
+    else:
+        dw = np.ones(1)
+    power = np.maximum(s, 0.0) * dw
+    if not power.sum() > 0:
+        raise ValueError('Spectrum has no power in the table range '
+                         '%.1f - %.1f' % (w[0], w[-1]))
+    power /= power.sum()
+    mid = np.cumsum(power) - 0.5 * power
+    bins = np.minimum((mid * n_bins).astype(int), n_bins - 1)
+
+    rvs = table['rvs']
+    cross = table['crossSections']
+    icdf = table['inverseCDF']
+    bands = []
+    band_cross = []
+    band_icdf = []
+    for b in range(n_bins):
+        members = np.nonzero((bins == b) & (power > 0))[0]
+        if len(members) == 0:
+            continue
+        p = power[members]
+        bands.append([np.sum(p * w[members]) / p.sum(), w[members[0]],
+                      w[members[-1]], p.sum()])
+        band_cross.append(np.sum(p * cross[:, members], axis=1) / p.sum())
+        weights = p * cross[:, members]
+        band_icdf.append([mixInverseCDFs(icdf[i, members], weights[i], rvs)
+                          for i in range(len(cross))])
+
+    band = dict(table)
+    # Per wavelength representations do not apply to bands
+    band.pop('alias', None)
+    band.pop('phaseFit', None)
+    band['bands'] = np.array(bands)
+    band['wavelengths'] = band['bands'][:, 0]
+    band['crossSections'] = np.array(band_cross).T
+    band['inverseCDF'] = np.ascontiguousarray(
+        np.array(band_icdf).transpose(1, 0, 2))
+    return(band)
+
+
+def mixTables(tables, number_densities):
+    '''
+    Effective table of a mixture of particle species, each given by its
+    effective table (one particle row) and number density (particles
+    per um^3). The tables must share the wavelength grid; inverse CDFs
+    on different RV grids are resampled onto a uniform grid of the
+    largest number of RVs.
+
+    The cross section is the number weighted mean, so that cross
+    section times the total number density is the summed extinction
+    coefficient of the species. The inverse CDF of each wavelength is
+    that of the mixture of the phase functions weighted by number
+    density times cross section (see mixInverseCDFs).
+
+    :return: The mixture table, with numberDensity (total) and
+             fractions (number fraction of each species)
+    :rtype: dict
+    '''
+    density = np.asarray(number_densities, dtype=float)
+    if len(tables) == 0 or len(tables) != len(density):
+        raise ValueError('One number density per table is needed')
+    if np.any(density < 0) or not density.sum() > 0:
+        raise ValueError('Number densities must be non-negative with a '
+                         'positive total')
+    w = np.asarray(tables[0]['wavelengths'], dtype=float)
+    for table in tables:
+        if (len(table['wavelengths']) != len(w) or
+                not np.allclose(table['wavelengths'], w)):
+            raise ValueError('Mixed tables must share the wavelengths')
+    rvs = tables[0]['rvs']
+    if any([len(t['rvs']) != len(rvs) or not np.allclose(t['rvs'], rvs)
+            for t in tables]):
+        rvs = np.linspace(0, 1, max([len(t['rvs']) for t in tables]))
+        tables = [resampleRVs(t, rvs) for t in tables]
+
+    fractions = density / density.sum()
+    # (species, wavelength) of the first particle row of each table
+    cross = np.array([t['crossSections'][0] for t in tables])
+    icdf = np.array([t['inverseCDF'][0] for t in tables])
+    weights = fractions[:, np.newaxis] * cross
+    mixed = [mixInverseCDFs(icdf[:, i], weights[:, i], rvs)
+             for i in range(len(w))]
+
+    mixture = {'wavelengths': w,
+               'particleDiameter': np.array([np.sum(
+                   fractions * [t['particleDiameter'][0]
+                                for t in tables])]),
+               'crossSections': np.sum(weights, axis=0)[np.newaxis],
+               'inverseCDF': np.array(mixed)[np.newaxis],
+               'rvs': rvs,
+               'numberDensity': density.sum(),
+               'fractions': fractions}
+    return(mixture)
+
+
+def inverseCDFColumns(table, particle_id=0):
+    '''
+    Returns the inverse CDF of one particle in the property orientation
+    (Row = RV, Column = wavelength).
+    '''
+    return(np.ascontiguousarray(table['inverseCDF'][particle_id].T))
@@ -0,0 +1,172 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+
+import numpy as np
+from numpy.polynomial import legendre
+from scipy.integrate import cumtrapz
+from scipy.optimize import minimize, nnls
+
+from . import scatteringTools as st
+
+# Parametric phase function models. 'hgN' is a sum of N Henyey-Greenstein
+# lobes with parameters (weight, g) of each lobe, 'legendreN' the first N
+# Legendre moments chi_0 ... chi_N-1 of the phase function (chi_1 = g).
+MODELS = ('hg', 'legendre')
+# Max lobes of a Henyey-Greenstein fit
+HG_MAX_LOBES = 4
+G_MAX = 0.99999
+
+
+def parseModel(spec):
+    '''
+    (model, n) of a model spec such as hg2, hg3 or legendre16.
+    '''
+    match = re.match(r'^(hg|legendre)(\d+)$', str(spec))
+    if match is None:
+        raise ValueError('Unknown phase function model %s, use hgN or '
+                         'legendreN' % str(spec))
+    (model, n) = (match.group(1), int(match.group(2)))
+    if n < 1 or (model == 'hg' and n > HG_MAX_LOBES):
+        raise ValueError('Bad number of terms in %s' % spec)
+    return(model, n)
+
+
+def parameterCount(spec):
+    (model, n) = parseModel(spec)
+    return(2 * n if model == 'hg' else n)
+
+
+def angleCDF(theta, density):
+    '''
+    Normalized cumulative distribution of an angle density over theta.
+    '''
+    cdf = cumtrapz(density, theta, initial=0)
+    return(cdf / cdf[-1])
+
+
+def henyeyGreensteinCDF(theta, parameters):
+    '''
+    Cumulative distribution over theta (radians) of a sum of
+    Henyey-Greenstein lobes, parameters (weight, g) of each lobe.
+    '''
+    p = np.asarray(parameters, dtype=float).reshape(-1, 2)
+    return(sum([w * st.henyeyGreensteinCDFTheta(theta, g) for (w, g) in p]))
+
+
+def legendreDensity(theta, moments):
+    '''
+    Angle density over theta of a truncated Legendre expansion with
+    moments chi_l, p(mu) = sum (2l + 1) / 2 chi_l P_l(mu).
+    '''
+    moments = np.asarray(moments, dtype=float)
+    c = moments * (2 * np.arange(len(moments)) + 1) / 2.0
+    return(legendre.legval(np.cos(theta), c) * np.sin(theta))
+
+
+def legendreMoments(theta, density, n_moments):
+    '''
+    First n_moments Legendre moments of an angle density over theta,
+    chi_l = integral of P_l(cos theta) density(theta) dtheta.
+    '''
+    mu = np.cos(theta)
+    density = np.asarray(density, dtype=float)
+    density = density / np.trapz(density, theta)
+    return(np.array([np.trapz(legendre.legval(mu, np.eye(l + 1)[l]) *
+                              density, theta)
+                     for l in range(n_moments)]))
+
+
+def _lobeWeights(basis, cdf):
+    # Non-negative weights summing to one (enforced by a heavy extra row)
+    # of the lobe CDFs in the columns of basis, and the residual
+    a = np.vstack([basis, 1e3 * np.ones(basis.shape[1])])
+    b = np.concatenate([cdf, [1e3]])
+    (w, residual) = nnls(a, b)
+    return(w / w.sum(), residual)
+
+
+def fitHenyeyGreenstein(theta, density, n_lobes=2):
+    '''
+    Least squares fit of a sum of n_lobes Henyey-Greenstein lobes to the
+    cumulative distribution of an angle density over theta (radians).
+    Weights are positive and sum to one.
+
+    For given asymmetries the weights are a linear problem, so lobes are
+    first picked greedily from a grid of asymmetries and then refined
+    with the weights solved exactly at every step.
+
+    :return: (weight, g) of each lobe, flattened
+    :rtype: numpy.ndarray
+    '''
+    cdf = angleCDF(theta, density)
+    candidates = np.concatenate([np.linspace(-0.9, 0.9, 37),
+                                 1.0 - np.logspace(-3.5, -1.3, 16)])
+    basis = np.column_stack([st.henyeyGreensteinCDFTheta(theta, g)
+                             for g in candidates])
+    picked = []
+    for i in range(n_lobes):
+        trials = [(_lobeWeights(basis[:, picked + [j]], cdf)[1], j)
+                  for j in range(len(candidates)) if j not in picked]
+        picked.append(min(trials)[1])
+
+    def residual(x):
+        g = G_MAX * np.tanh(x)
+        lobes = np.column_stack([st.henyeyGreensteinCDFTheta(theta, gi)
+                                 for gi in g])
+        return(_lobeWeights(lobes, cdf)[1])
+
+    x0 = np.arctanh(candidates[picked] / G_MAX)
+    x = minimize(residual, x0, method='Nelder-Mead',
+                 options={'maxiter': 200 * n_lobes}).x
+    if not residual(x) <= residual(x0):
+        x = x0
+    g = G_MAX * np.tanh(x)
+    lobes = np.column_stack([st.henyeyGreensteinCDFTheta(theta, gi)
+                             for gi in g])
+    w = _lobeWeights(lobes, cdf)[0]
+    return(np.column_stack([w, g]).ravel())
+
+
+def fitPhaseFunction(theta, density, spec):
+    '''
+    Fits the parametric model spec to an angle density over theta.
+
+    The fit error is the max difference between the cumulative
+    distributions of the model and the density (0 - 1), the largest
+    error in the probability of scattering below any angle.
+
+    :return: (parameters, error)
+    '''
+    (model, n) = parseModel(spec)
+    density = np.asarray(density, dtype=float)
+    if model == 'hg':
+        parameters = fitHenyeyGreenstein(theta, density, n)
+        fitted = henyeyGreensteinCDF(theta, parameters)
+    else:
+        parameters = legendreMoments(theta, density, n)
+        fitted = cumtrapz(legendreDensity(theta, parameters), theta,
+                          initial=0)
+    error = np.max(np.abs(fitted - angleCDF(theta, density)))
+    return(parameters, error)
+
+
+def fitPhaseFunctionTask(data):
+    '''
+    fitPhaseFunction of a (theta, density, spec) tuple, for worker pools.
+    '''
+    return(fitPhaseFunction(*data))
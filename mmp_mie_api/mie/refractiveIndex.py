@@ -0,0 +1,169 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numbers
+
+import numpy as np
+
+# Dispersion models of a refractive index. Coefficients are those of
+# catalogs, for wavelengths l in um:
+#   cauchy:    n = A + B / l^2 + C / l^4 + ..., coefficients [A, B, C, ...]
+#   sellmeier: n^2 = 1 + sum B_i l^2 / (l^2 - C_i), C_i in um^2
+#   table:     n and k linearly interpolated between wavelengths (nm)
+# cauchy and sellmeier take an optional constant extinction coefficient k.
+MODELS = ('cauchy', 'sellmeier', 'table')
+# Wavelength (nm) of the nominal index of a dispersive material, the
+# sodium D line of catalog indices n_D
+REFERENCE_WAVELENGTH = 589.3
+
+
+def _floats(values, name):
+    values = np.asarray(values, dtype=float).ravel()
+    if len(values) == 0 or not np.all(np.isfinite(values)):
+        raise ValueError('Bad %s of a refractive index model' % name)
+    return([float(v) for v in values])
+
+
+def parseIndex(n):
+    '''
+    Normalized refractive index: a complex constant or a dict of a
+    dispersion model of MODELS, such as
+    {'model': 'cauchy', 'coefficients': [1.5, 0.004], 'k': 0.0} or
+    {'model': 'table', 'wavelengths': [...], 'n': [...], 'k': [...]}.
+    A table can also be given as an array of two (wavelengths, n) or
+    three (wavelengths, n, k) rows.
+    '''
+    if isinstance(n, numbers.Number):
+        return(complex(n))
+    if not isinstance(n, dict):
+        a = np.asarray(n, dtype=float)
+        if a.ndim == 0:
+            return(complex(a))
+        if a.ndim != 2 or a.shape[0] not in (2, 3):
+            raise ValueError('Refractive index tables have two or three '
+                             'rows: wavelengths, n and k')
+        n = {'model': 'table', 'wavelengths': a[0], 'n': a[1]}
+        if a.shape[0] == 3:
+            n['k'] = a[2]
+    model = n.get('model')
+    if model == 'cauchy':
+        spec = {'coefficients': _floats(n.get('coefficients'),
+                                        'coefficients')}
+    elif model == 'sellmeier':
+        spec = {'B': _floats(n.get('B'), 'B'), 'C': _floats(n.get('C'), 'C')}
+        if len(spec['B']) != len(spec['C']):
+            raise ValueError('Sellmeier B and C differ in length')
+    elif model == 'table':
+        spec = {'wavelengths': _floats(n.get('wavelengths'), 'wavelengths'),
+                'n': _floats(n.get('n'), 'n')}
+        if len(spec['n']) != len(spec['wavelengths']):
+            raise ValueError('Refractive index table n and wavelengths '
+                             'differ in length')
+        if np.any(np.diff(spec['wavelengths']) <= 0):
+            raise ValueError('Refractive index table wavelengths must '
+                             'increase')
+    else:
+        raise ValueError('Unknown refractive index model %s, use one of %s'
+                         % (str(model), ', '.join(MODELS)))
+    spec['model'] = model
+    k = n.get('k', 0.0)
+    if model == 'table' and np.ndim(k) > 0:
+        spec['k'] = _floats(k, 'k')
+        if len(spec['k']) != len(spec['wavelengths']):
+            raise ValueError('Refractive index table k and wavelengths '
+                             'differ in length')
+    else:
+        spec['k'] = _floats(k, 'k')[0]
+    return(spec)
+
+
+def isDispersive(n):
+    return(isinstance(parseIndex(n), dict))
+
+
+def indexKey(n, real=False):
+    '''
+    Entry of a table key: [real, imaginary] (or the real part only with
+    real) of a constant, the normalized model of a dispersive material.
+    '''
+    n = parseIndex(n)
+    if isinstance(n, dict):
+        return(n)
+    if real:
+        return(float(n.real))
+    return([float(n.real), float(n.imag)])
+
+
+def evaluate(n, wavelengths, step=None):
+    '''
+    Complex refractive index at each wavelength (nm).
+
+    Tables are extrapolated with their end values. With step the real
+    parts are rounded to multiples of step and the imaginary parts to
+    the same relative precision, so that nearby dispersion curves give
+    equal indices and share the Mie kernels of the generator.
+    '''
+    n = parseIndex(n)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if not isinstance(n, dict):
+        values = np.full(wavelengths.shape, n, dtype=complex)
+    else:
+        l2 = (wavelengths / 1000.0) ** 2
+        if n['model'] == 'cauchy':
+            real = sum([c * l2 ** (-i)
+                        for (i, c) in enumerate(n['coefficients'])])
+        elif n['model'] == 'sellmeier':
+            real = np.sqrt(1.0 + sum([b * l2 / (l2 - c) for (b, c)
+                                      in zip(n['B'], n['C'])]) + 0j).real
+        else:
+            real = np.interp(wavelengths, n['wavelengths'], n['n'])
+        k = n['k']
+        if n['model'] == 'table' and isinstance(k, list):
+            k = np.interp(wavelengths, n['wavelengths'], k)
+        values = real + 1j * np.asarray(k)
+        if not (np.all(np.isfinite(values)) and np.all(values.real > 0)):
+            raise ValueError('Refractive index model %s is not physical '
+                             'at %.1f - %.1f nm' % (n['model'],
+                                                    wavelengths.min(),
+                                                    wavelengths.max()))
+    if step is not None:
+        values = quantize(values, step)
+    return(values)
+
+
+def quantize(values, step):
+    '''
+    Rounds the real parts of complex indices to multiples of step and
+    the imaginary parts to step relative to their magnitude.
+    '''
+    values = np.asarray(values, dtype=complex)
+    real = np.round(values.real / step) * step
+    imag = values.imag
+    scale = np.where(imag != 0,
+                     10.0 ** np.floor(np.log10(np.abs(imag) +
+                                               (imag == 0))),
+                     1.0) * step
+    imag = np.round(imag / scale) * scale
+    return(real + 1j * imag)
+
+
+def nominal(n):
+    '''
+    Complex index of a constant, or of a dispersive material at
+    REFERENCE_WAVELENGTH. Used where a single value is needed, as in
+    the columns of the table database.
+    '''
+    return(complex(evaluate(n, [REFERENCE_WAVELENGTH])[0]))
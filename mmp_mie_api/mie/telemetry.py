@@ -0,0 +1,134 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import threading
+import time
+
+
+class Telemetry():
+
+    '''
+    Thread safe counters, gauges and timers of the Mie generation and
+    database. One process wide instance (telemetry) is shared by all
+    modules.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dumpThread = None
+        self.dumpStop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self.startTime = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            (n, total) = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (n + 1, total + seconds)
+
+    def timer(self, name):
+        '''
+        Context manager adding the wall time of the block to timer name.
+        '''
+        return(_Timer(self, name))
+
+    def snapshot(self):
+        '''
+        :return: Counters, gauges and timers (count, total and mean
+                 seconds) as a dict.
+        :rtype: dict
+        '''
+        with self.lock:
+            timers = {}
+            for (name, (n, total)) in self.timers.items():
+                timers[name] = {'count': n,
+                                'total': total,
+                                'mean': total / n if n else 0.0}
+            snap = {'time': time.time(),
+                    'uptime': time.time() - self.startTime,
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'timers': timers}
+        generation = timers.get('generation', {}).get('total', 0.0)
+        if generation > 0:
+            snap['kernelTasksPerSecond'] = (
+                snap['counters'].get('kernelTasks', 0) / generation)
+        return(snap)
+
+    def dumpJSONLines(self, fname, extra=None):
+        '''
+        Appends a snapshot (updated with dict extra) as one JSON line.
+        '''
+        snap = self.snapshot()
+        if extra:
+            snap.update(extra)
+        f = open(fname, 'a')
+        f.write(json.dumps(snap) + '\n')
+        f.close()
+
+    def startPeriodicDump(self, fname, interval=60.0, extra=None):
+        '''
+        Dumps a snapshot to fname every interval seconds in a background
+        thread. extra is a function returning a dict added to each line.
+        '''
+        self.stopPeriodicDump()
+        self.dumpStop.clear()
+
+        def loop():
+            while not self.dumpStop.wait(interval):
+                self.dumpJSONLines(fname, extra() if extra else None)
+
+        self.dumpThread = threading.Thread(target=loop)
+        self.dumpThread.daemon = True
+        self.dumpThread.start()
+
+    def stopPeriodicDump(self):
+        if self.dumpThread is not None:
+            self.dumpStop.set()
+            self.dumpThread.join()
+            self.dumpThread = None
+
+
+class _Timer():
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return(self)
+
+    def __exit__(self, *args):
+        self.telemetry.addTime(self.name, time.time() - self.start)
+        return(False)
+
+
+telemetry = Telemetry()
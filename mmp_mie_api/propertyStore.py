@@ -0,0 +1,112 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+
+
+class PropertyStore():
+
+    '''
+    Container of properties or fields keyed by tuples, for example
+    (propertyID, objectID, tstep). Keyed get and set are O(1) and every
+    key level has a secondary index, so selecting by propertyID, objectID
+    or tstep only touches the matching items.
+    '''
+
+    def __init__(self, names=('propertyID', 'objectID', 'tstep')):
+        self.names = tuple(names)
+        self.items = {}
+        self.indexes = dict((name, {}) for name in self.names)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return(len(self.items))
+
+    def __contains__(self, key):
+        return(key in self.items)
+
+    def __getitem__(self, key):
+        return(self.items[key])
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key not in self.items:
+                for (name, level) in zip(self.names, key):
+                    self.indexes[name].setdefault(level, set()).add(key)
+            self.items[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.items[key]
+            for (name, level) in zip(self.names, key):
+                keys = self.indexes[name][level]
+                keys.discard(key)
+                if not keys:
+                    del self.indexes[name][level]
+
+    def keys(self):
+        return(list(self.items.keys()))
+
+    def values(self):
+        return(list(self.items.values()))
+
+    def contains(self, name, level):
+        '''
+        True if any key has the given value on level name.
+        '''
+        return(level in self.indexes[name])
+
+    def levels(self, name):
+        '''
+        Values present on level name.
+        '''
+        return(list(self.indexes[name].keys()))
+
+    def select(self, **levels):
+        '''
+        Items whose keys match all given levels, for example
+        select(propertyID=pid, tstep=0).
+
+        :return: Matching items
+        :rtype: dict
+        '''
+        with self.lock:
+            keys = None
+            for (name, level) in levels.items():
+                match = self.indexes[name].get(level, set())
+                keys = set(match) if keys is None else keys & match
+            if keys is None:
+                keys = self.items.keys()
+            return(dict((key, self.items[key]) for key in keys))
+
+    def prune(self, before, keep=(0,)):
+        '''
+        Removes items of time steps earlier than before. Time steps in
+        keep (by default the initial values of step 0) are kept.
+
+        :return: Number of removed items
+        :rtype: int
+        '''
+        name = self.names[-1]
+        with self.lock:
+            old = [level for level in self.indexes[name]
+                   if level < before and level not in keep]
+            removed = 0
+            for level in old:
+                for key in list(self.indexes[name].get(level, ())):
+                    del self[key]
+                    removed += 1
+        return(removed)
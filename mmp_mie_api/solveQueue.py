@@ -0,0 +1,200 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import itertools
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('mmpMIE')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+
+
+class SolveFuture():
+
+    '''
+    Result of a queued solve request. The jobs of a queued request are
+    dicts keyed by particle object ID; objects taken over by a newer
+    request are recorded in supersededBy.
+    '''
+
+    def __init__(self, requestID, jobs, kwargs):
+        self.requestID = requestID
+        self.jobs = dict(jobs)
+        self.objectIDs = sorted(self.jobs.keys())
+        self.kwargs = kwargs
+        self.state = QUEUED
+        self.supersededBy = {}
+        self.value = None
+        self.error = None
+        self.event = threading.Event()
+
+    def done(self):
+        return(self.event.is_set())
+
+    def wait(self, timeout=None):
+        '''
+        :return: True if the request finished within timeout seconds
+        :rtype: bool
+        '''
+        self.event.wait(timeout)
+        return(self.event.is_set())
+
+    def result(self, timeout=None):
+        '''
+        Waits for the request and returns its result. The exception of a
+        failed request is raised.
+        '''
+        if not self.wait(timeout):
+            raise RuntimeError('Solve request %d not finished' %
+                               self.requestID)
+        if self.error is not None:
+            raise self.error
+        return(self.value)
+
+    def status(self):
+        '''
+        Plain status dict, which can be sent over Pyro.
+        '''
+        return({'requestID': self.requestID,
+                'state': self.state,
+                'objectIDs': list(self.objectIDs),
+                'pending': sorted(self.jobs.keys()),
+                'supersededBy': dict(self.supersededBy),
+                'error': None if self.error is None else str(self.error)})
+
+    def _finish(self, state, value=None, error=None):
+        self.state = state
+        self.value = value
+        self.error = error
+        self.event.set()
+
+
+class SolveQueue():
+
+    '''
+    Runs solve requests one at a time in a worker thread. A new request
+    takes over the objects of older requests still in the queue, so
+    superseded parameters are never solved.
+
+    solve is called as solve(jobs, **kwargs) with the remaining jobs of
+    a request. With coalesce=False every request is solved as such.
+    '''
+
+    def __init__(self, solve, history=1000, coalesce=True):
+        self.solve = solve
+        self.history = history
+        self.coalesce = coalesce
+        self.queue = deque()
+        self.futures = OrderedDict()
+        self.running = None
+        self.ids = itertools.count(1)
+        self.cond = threading.Condition()
+        self.worker = None
+
+    def submit(self, jobs, **kwargs):
+        '''
+        Queues a request.
+
+        :return: Future of the request
+        :rtype: SolveFuture
+        '''
+        with self.cond:
+            future = SolveFuture(next(self.ids), jobs, kwargs)
+            if self.coalesce:
+                for older in list(self.queue):
+                    self._coalesce(older, future)
+            self.queue.append(future)
+            self.futures[future.requestID] = future
+            while len(self.futures) > self.history:
+                oldest = next(iter(self.futures))
+                if not self.futures[oldest].done():
+                    break
+                del self.futures[oldest]
+            self._startWorker()
+            self.cond.notify_all()
+        return(future)
+
+    def future(self, requestID):
+        with self.cond:
+            if requestID not in self.futures:
+                raise KeyError('Unknown solve request %s' % str(requestID))
+            return(self.futures[requestID])
+
+    def idle(self):
+        '''
+        True if nothing is queued or running.
+        '''
+        with self.cond:
+            return(not self.queue and self.running is None)
+
+    def join(self, timeout=None):
+        '''
+        Waits until the queue is idle.
+
+        :return: True if the queue became idle within timeout seconds
+        :rtype: bool
+        '''
+        with self.cond:
+            if timeout is None:
+                while self.queue or self.running is not None:
+                    self.cond.wait()
+            elif self.queue or self.running is not None:
+                self.cond.wait(timeout)
+            return(not self.queue and self.running is None)
+
+    def _coalesce(self, older, newer):
+        taken = [objectID for objectID in older.jobs
+                 if objectID in newer.jobs]
+        for objectID in taken:
+            del older.jobs[objectID]
+            older.supersededBy[objectID] = newer.requestID
+        if taken and not older.jobs:
+            self.queue.remove(older)
+            older._finish(SUPERSEDED)
+            logger.debug('Solve request %d superseded by %d' %
+                         (older.requestID, newer.requestID))
+
+    def _startWorker(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._loop)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                future = self.queue.popleft()
+                future.state = RUNNING
+                self.running = future
+            try:
+                value = self.solve(dict(future.jobs), **future.kwargs)
+            except Exception as e:
+                logger.exception('Solve request %d failed' %
+                                 future.requestID)
+                future._finish(FAILED, error=e)
+            else:
+                future._finish(DONE, value)
+            with self.cond:
+                self.running = None
+                self.cond.notify_all()
@@ -0,0 +1,118 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import importlib
+import itertools
+import os
+import sys
+from datetime import datetime
+
+from .mie import mieDatabase
+from .mie import scatteringTools as st
+
+# Grid used by MMPMie
+defaultGrid = {'wavelen_n': 1001,
+               'wavelen_max': 1100.0,
+               'wavelen_min': 100.0,
+               'particle_n': 50,
+               'particle_max': 35.0,
+               'particle_min': 1.0}
+
+parser = argparse.ArgumentParser(
+    description='Pre-generate Mie tables for a parameter sweep.')
+parser.add_argument("sweepFile",
+                    help='Sweep specification filename (py format)',
+                    type=str)
+
+
+def sweepParameters(spec):
+    '''
+    Parameter sets of a sweep specification module.
+
+    The module may define:
+    refractiveIndices -- particle refractive indices (can be complex)
+    hostIndices -- host refractive indices
+    distributions -- (mu, sigma) pairs of log-normal distributions
+    dValues -- (D10, D50, D90) triples, fitted to (mu, sigma)
+    grids -- list of grid dicts (wavelen_n, wavelen_max, wavelen_min,
+             particle_n, particle_max, particle_min, theta_n, rv_n)
+    profile -- resolution profile of the default grid (draft, standard
+               or production)
+    effectiveModel -- default True
+    '''
+    base = dict(defaultGrid)
+    if hasattr(spec, 'profile'):
+        base.update(mieDatabase.resolutionProfile(spec.profile))
+
+    dists = list(getattr(spec, 'distributions', []))
+    for (d10, d50, d90) in getattr(spec, 'dValues', []):
+        dists.append(st.fitLogNormParticleDistribution(d10, d50, d90))
+
+    param_sets = []
+    for (n_p, n_h, (mu, sigma), grid) in itertools.product(
+            getattr(spec, 'refractiveIndices'),
+            getattr(spec, 'hostIndices'),
+            dists,
+            getattr(spec, 'grids', [base])):
+        ps = dict(base)
+        ps.update(grid)
+        ps.update({'n_particle': n_p,
+                   'n_host': n_h,
+                   'particle_mu': mu,
+                   'particle_sigma': sigma,
+                   'effective_model': getattr(spec, 'effectiveModel', True)})
+        param_sets.append(ps)
+    return(param_sets)
+
+
+def main():
+    # Parse arguments
+    args = parser.parse_args()
+    sys.path.append(os.getcwd())
+
+    # Load sweep specification
+    conf = args.sweepFile
+    if conf[-3:] == '.py':
+        conf = conf[:-3]
+    print(conf)
+
+    spec = importlib.import_module(conf)
+    param_sets = sweepParameters(spec)
+
+    mieDB = mieDatabase.MieDatabase(processes=getattr(spec, 'processes',
+                                                      None))
+    # Skip already cached keys
+    pending = [ps for ps in param_sets
+               if mieDB.cachedMieParameters(**ps) is None]
+    tasks = sum([ps['wavelen_n'] * ps['particle_n'] for ps in pending])
+
+    print(80 * '-')
+    print("Sweep of %d tables, %d cached, %d to generate" %
+          (len(param_sets), len(param_sets) - len(pending), len(pending)))
+    startTime = datetime.now()
+    mieDB.mieParametersMany(pending)
+    seconds = max((datetime.now() - startTime).total_seconds(), 1e-9)
+
+    print(80 * '-')
+    print("Generated %d tables in %s" %
+          (len(pending), str(datetime.now() - startTime).split('.', 2)[0]))
+    print("Throughput: %.2f tables/h, %.1f kernel tasks/s" %
+          (len(pending) * 3600.0 / seconds, tasks / seconds))
+    print(80 * '-')
+
+if __name__ == '__main__':
+    main()
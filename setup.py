@@ -32,7 +32,8 @@ setup(name='mmp_mie_api',
            'mieServer:runSingleServerInstanceNoNat',
            'runMieServerSingleSSHtunnel=mmp_mie_api.' +
            'mieServer:runSingleServerInstanceSSHtunnel',
-           'killMieServer = mmp_mie_api.killMieServer:main']
+           'killMieServer = mmp_mie_api.killMieServer:main',
+           'warmMieCache = mmp_mie_api.warmMieCache:main']
       },
       eager_resources={},
       # This line is only for python setup.py bdist, for PyPI see MANIFEST.in
@@ -0,0 +1,55 @@
+#
+# Copyright 2015 VTT Technical Research Center of Finland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Changing a storage setting must solve and republish the particle
+# types on the next solveStep even if no physical input changed.
+
+from mupif import PropertyID
+import mmp_mie_api as mie
+from mmp_mie_api import objID
+
+
+def republished(mieApp, setter, *args):
+    objectID = objID.OBJ_PARTICLE_TYPE_1
+    before = mieApp.getTableInfo(objectID)['filename']
+    setter(*args)
+    requestID = mieApp.solveStep(1)
+    assert requestID is not None, 'Solve skipped after %s' % setter.__name__
+    after = mieApp.getTableInfo(objectID)['filename']
+    assert after != before, 'Table not republished after %s' % \
+        setter.__name__
+    print('%s%s republished %s' % (setter.__name__, str(args), after))
+
+
+if __name__ == '__main__':
+
+    mieApp = mie.MMPMie('/dev/null')
+    mieApp.setResolution('draft')
+    mieApp.solveStep(1)
+    # Unchanged inputs are skipped
+    assert mieApp.solveStep(1) is None
+
+    republished(mieApp, mieApp.setPrecision, 'uint16')
+    republished(mieApp, mieApp.setSampling, 'alias')
+    republished(mieApp, mieApp.setRVTolerance, 0.01)
+    republished(mieApp, mieApp.setPhaseFit, 'hg2')
+    for pid in (PropertyID.PID_PhaseFitParameters,
+                PropertyID.PID_PhaseFitError,
+                PropertyID.PID_AsymmetryFactor):
+        mieApp.getProperty(pid, 0, objID.OBJ_PARTICLE_TYPE_1)
+    republished(mieApp, mieApp.setRegimeTolerance, 0.05)
+    republished(mieApp, mieApp.setIndexStep, 1e-4)
+    mieApp.terminate()